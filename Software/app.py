@@ -1,14 +1,58 @@
 import requests
-import pyftdi.serialext
+from requests.adapters import HTTPAdapter
 import datetime
 import configparser
 import threading
 import os
 import queue
 import time
+import struct
+import random
+import collections
+import copy
+import logging
+import atexit
+from logging.handlers import QueueHandler, QueueListener
+import json
+import sqlite3
+import gzip
+import zlib
+import asyncio
+import concurrent.futures
+import socket
+import select
 from pathlib import Path
-
-from flask import Flask, request, render_template, jsonify
+from urllib.parse import urlsplit
+
+from flask import Flask, request, render_template, jsonify, Response
+
+# aiohttp is only needed for the asyncio engine
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+# pyftdi is only needed for ftdi:// serial ports and pyserial for device paths
+try:
+    import pyftdi.serialext
+except ImportError:
+    pyftdi = None
+
+try:
+    import serial
+except ImportError:
+    serial = None
+
+# msgpack and zstandard are only needed for those upload encodings
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 # Paths and configuration
 source_path = Path(__file__).resolve()
@@ -21,9 +65,6 @@ xptrack_name = "xptrack"
 
 app = Flask(__name__)
 
-# Open a serial port on the second FTDI device interface (IF/2) @ 115200 baud
-port = pyftdi.serialext.serial_for_url("ftdi://ftdi:232:/1", baudrate=115200)
-
 
 def write_file():
     with open(configLocation, "w") as configfile:
@@ -35,12 +76,247 @@ if not os.path.exists(configLocation):
         "server_url": "https://example.com",
         "api_key": "your_api_key_here",
         "serial_port_url": "ftdi://ftdi:232:/1",
-        "baud_rate": "115200"
+        "baud_rate": "115200",
+        "read_timeout": "0.05",
+        "read_chunk_size": "4096",
+        "api_mode": "1",
+        "io_sample_rate": "1000",
+        "http_pool_size": "4",
+        "batch_size": "1",
+        "batch_wait": "200",
+        "destination_queue_size": "10000",
+        "spool_path": "",
+        "spool_max_entries": "1000000",
+        "spool_commit_interval": "1000",
+        "engine": "threads",
+        "async_queue_size": "1000",
+        "retry_max_retries": "5",
+        "retry_base_delay": "0.5",
+        "retry_max_delay": "30",
+        "breaker_failure_threshold": "5",
+        "breaker_reset_timeout": "10",
+        "breaker_max_reset_timeout": "300",
+        "config_poll_interval": "2",
+        "log_level": "INFO",
+        "log_rate_limit": "10",
+        "log_queue_size": "10000",
+        "capture_path": "",
+        "capture_max_bytes": "10000000",
+        "capture_max_files": "10",
+        "capture_queue_size": "1000",
+        "filter_deadband": "0",
+        "filter_min_interval": "0",
+        "filter_max_interval": "0",
+        "filter_window": "0",
+        "filter_aggregate": "mean",
+        "upload_format": "json",
+        "upload_compression": "none"
     }
     write_file()
 else:
     config.read(configLocation)
-    print(config.sections())
+
+
+# Logging goes through a queue so the serial reader and workers never wait on
+# stdout; a listener thread does the formatting and writing.
+# Messages repeated within log_rate_limit seconds are dropped, with a count of
+# how many were dropped added to the next one that gets through. Messages are
+# told apart by their template and string arguments, such as a destination URL
+# or node address, so numbers and exception text that change every time don't
+# get around the limit. Debug output is never dropped.
+class RateLimitFilter(logging.Filter):
+    def __init__(self, interval):
+        super().__init__()
+        self.interval = interval
+        self.last_logged = {}
+        self.lock = threading.Lock()
+        self.next_sweep = 0
+
+    def filter(self, record):
+        if self.interval <= 0 or record.levelno <= logging.DEBUG:
+            return True
+        args = record.args if isinstance(record.args, tuple) else ()
+        key = (record.levelno, record.msg, tuple(arg for arg in args if isinstance(arg, str)))
+        now = time.monotonic()
+        with self.lock:
+            if now >= self.next_sweep:
+                self.sweep(now)
+            last_time, suppressed = self.last_logged.get(key, (None, 0))
+            if last_time is not None and now - last_time < self.interval:
+                self.last_logged[key] = (last_time, suppressed + 1)
+                return False
+            self.last_logged[key] = (now, 0)
+        if suppressed:
+            record.msg = "{} ({} repeats suppressed)".format(record.getMessage(), suppressed)
+            record.args = None
+        return True
+
+    # Forget messages that can no longer be suppressed and have no count to
+    # report, so the table only holds what was logged recently
+    def sweep(self, now):
+        self.next_sweep = now + self.interval
+        self.last_logged = {
+            key: (last_time, suppressed) for key, (last_time, suppressed) in self.last_logged.items()
+            if suppressed or now - last_time < self.interval
+        }
+
+# Merges the arguments into the message before queueing, so a queued record holds
+# no references to them (an exception passed as an argument would otherwise keep
+# its traceback, and the frame buffers it points into, alive). Timestamps and the
+# rest of the formatting are left to the listener thread. Records are dropped
+# rather than blocking if the listener falls behind.
+class BufferedQueueHandler(QueueHandler):
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+        record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+def setup_logging():
+    stream_handler = logging.StreamHandler()
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(threadName)s: %(message)s"))
+
+    log_queue = queue.Queue(maxsize=config["ServerConf"].getint("log_queue_size", 10000))
+    listener = QueueListener(log_queue, stream_handler)
+    listener.start()
+    atexit.register(listener.stop)
+
+    logger = logging.getLogger("xbeeserver")
+    logger.setLevel(config["ServerConf"].get("log_level", "INFO").upper())
+    # Rate limited before queueing, while the record still has its arguments
+    queue_handler = BufferedQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(config["ServerConf"].getfloat("log_rate_limit", 10)))
+    logger.addHandler(queue_handler)
+    logger.propagate = False
+    return logger
+
+logger = setup_logging()
+logger.info("Configuration sections: %s", config.sections())
+
+
+# Minimal Prometheus style metrics, served as text from /metrics.
+# Every metric registers itself in metrics_registry when it is created. Values are
+# kept per tuple of label values, and callback gauges are computed when scraped.
+metrics_registry = []
+
+class Metric:
+    metric_type = "untyped"
+
+    def __init__(self, name, help_text, label_names=()):
+        self.name = name
+        self.help_text = help_text
+        self.label_names = label_names
+        self.values = {}
+        self.lock = threading.Lock()
+        metrics_registry.append(self)
+
+    def format_labels(self, labels, extra=()):
+        pairs = list(zip(self.label_names, labels)) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join('{}="{}"'.format(name, str(value).replace('"', '\\"')) for name, value in pairs) + "}"
+
+    def collect(self):
+        with self.lock:
+            return dict(self.values)
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} {}".format(self.name, self.metric_type)]
+        values = self.collect()
+        if not values and not self.label_names:
+            values = {(): 0}
+        for labels, value in values.items():
+            lines.append("{}{} {}".format(self.name, self.format_labels(labels), value))
+        return lines
+
+class Counter(Metric):
+    metric_type = "counter"
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        return self.values.get(labels, 0)
+
+# A gauge is either set directly or, with a callback, computed at scrape time
+# from a {labels: value} dict returned by the callback
+class Gauge(Metric):
+    metric_type = "gauge"
+
+    def __init__(self, name, help_text, label_names=(), callback=None):
+        super().__init__(name, help_text, label_names)
+        self.callback = callback
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def collect(self):
+        if self.callback is not None:
+            return self.callback()
+        return super().collect()
+
+class Histogram(Metric):
+    metric_type = "histogram"
+
+    def __init__(self, name, help_text, label_names=(), buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)):
+        super().__init__(name, help_text, label_names)
+        self.buckets = buckets
+
+    def observe(self, value, labels=()):
+        with self.lock:
+            counts = self.values.get(labels)
+            if counts is None:
+                # One count per bucket, then the sum and total count
+                counts = self.values[labels] = [0] * len(self.buckets) + [0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            counts[-2] += value
+            counts[-1] += 1
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help_text), "# TYPE {} histogram".format(self.name)]
+        with self.lock:
+            values = {labels: list(counts) for labels, counts in self.values.items()}
+        for labels, counts in values.items():
+            for bound, count in zip(self.buckets, counts):
+                lines.append("{}_bucket{} {}".format(self.name, self.format_labels(labels, [("le", bound)]), count))
+            lines.append("{}_bucket{} {}".format(self.name, self.format_labels(labels, [("le", "+Inf")]), counts[-1]))
+            lines.append("{}_sum{} {}".format(self.name, self.format_labels(labels), counts[-2]))
+            lines.append("{}_count{} {}".format(self.name, self.format_labels(labels), counts[-1]))
+        return lines
+
+def render_metrics():
+    lines = []
+    for metric in metrics_registry:
+        lines += metric.render()
+    return "\n".join(lines) + "\n"
+
+# Label for every possible frame type, built up front so counting frames costs no formatting
+FRAME_TYPE_LABELS = [("{:#04x}".format(frame_type),) for frame_type in range(256)]
+
+frames_decoded = Counter("xbee_frames_decoded_total", "Frames with a valid checksum, by frame type", ("frame_type",))
+checksum_failures = Counter("xbee_checksum_failures_total", "Frames dropped for an invalid checksum")
+resync_bytes_discarded = Counter("xbee_resync_bytes_discarded_total", "Serial bytes skipped while looking for a valid frame")
+serial_bytes_read = Counter("xbee_serial_bytes_read_total", "Bytes read from the serial port")
+payloads_queued = Counter("xbee_payloads_queued_total", "Payloads queued for forwarding")
+payloads_filtered = Counter("xbee_payloads_filtered_total", "Readings held back or folded into a window by the edge filter")
+capture_chunks_dropped = Counter("xbee_capture_chunks_dropped_total", "Serial reads left out of the capture because the writer fell behind")
+post_duration = Histogram("xbee_post_duration_seconds", "Time taken by each POST request", ("destination",))
+payloads_delivered = Counter("xbee_payloads_delivered_total", "Payloads accepted by each destination", ("destination",))
+posts_sent = Counter("xbee_posts_total", "POST requests by destination and result", ("destination", "result"))
+post_retries = Counter("xbee_post_retries_total", "POST requests retried after a failure", ("destination",))
 
 
 def calculate_checksum(data):
@@ -68,71 +344,720 @@ def get_server_urls(url_string, route):
 def get_api_keys(api_string):
     return list(map(str.strip, api_string.split(',')))
 
+# Request headers for posting to a server with the given api key
+def get_headers(api_key):
+    return {
+        "Authorization": f"{api_key}",
+        "Content-Type": "application/json",
+    }
+
+
+# Pooled HTTP sessions, one per upstream server (scheme and host), so connections
+# and TLS sessions are kept alive between posts instead of reconnecting every time
+http_sessions = {}
+http_sessions_lock = threading.Lock()
+
+def get_http_session(server_url):
+    parts = urlsplit(server_url)
+    key = (parts.scheme, parts.netloc)
+    with http_sessions_lock:
+        session = http_sessions.get(key)
+        if session is None:
+            pool_size = config["ServerConf"].getint("http_pool_size", 4)
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session = requests.Session()
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            http_sessions[key] = session
+        return session
+
+
+# One configured destination server with everything needed to post to it
+Destination = collections.namedtuple(
+    "Destination", ["server_url", "api_key", "headers", "batch_url", "session", "upload_format", "compression"]
+)
+
+# The settings used while forwarding, parsed from the configuration once instead
+# of for every payload. A new snapshot is built and swapped in with a single
+# assignment whenever the configuration changes, so readers always see either
+# the old settings or the new ones and never a mix of both.
+ParsedConfig = collections.namedtuple(
+    "ParsedConfig",
+    ["destinations", "batch_size", "batch_wait", "queue_size", "pool_size", "io_sample_rate", "edge_filter", "node_filters"],
+)
+
+parsed_config = None
+parsed_config_lock = threading.Lock()
+
+# Upload encodings for batches. upload_format picks the layout: plain JSON, or
+# columnar, where the batch becomes one object with a list of node addresses and
+# arrays of node index, time since the previous reading (ms) and value:
+#   {"nodes": ["0013A20040A12345"], "base_time": 1694467656480,
+#    "node": [0, 0], "time": [0, 1000], "data": [1.5, 1.6]}
+# plus "channel" and "radio" arrays when any reading has them. msgpack is the
+# same columnar object in MessagePack. upload_compression compresses the body.
+upload_content_types = {
+    "json": "application/json",
+    "columnar": "application/vnd.xbee-columnar+json",
+    "msgpack": "application/vnd.xbee-columnar+msgpack",
+}
+
+upload_compressors = {
+    "none": None,
+    "gzip": gzip.compress,
+    "zstd": lambda data: zstandard.ZstdCompressor().compress(data),
+}
+
+# Read a comma separated upload setting, one value for every destination or one each
+def get_upload_settings(key, default, choices):
+    values = [value.strip().lower() for value in config["ServerConf"].get(key, default).split(",")]
+    for value in values:
+        if value not in choices:
+            raise ValueError("Unknown {}: {}".format(key, value))
+    if "msgpack" in values and msgpack is None:
+        raise ValueError("upload_format msgpack needs msgpack, install it with: pip install msgpack")
+    if "zstd" in values and zstandard is None:
+        raise ValueError("upload_compression zstd needs zstandard, install it with: pip install zstandard")
+    return values
+
+def encode_columnar(batch):
+    nodes = {}
+    columns = {"node": [], "time": [], "data": []}
+    channels = []
+    radios = []
+    base_time = last_time = batch[0]["date_time"]
+    for payload in batch:
+        columns["node"].append(nodes.setdefault(payload["source_address_64"], len(nodes)))
+        columns["time"].append(payload["date_time"] - last_time)
+        columns["data"].append(payload["data"])
+        channels.append(payload.get("channel"))
+        radios.append(payload.get("radio"))
+        last_time = payload["date_time"]
+
+    body = {"nodes": list(nodes), "base_time": base_time}
+    body.update(columns)
+    if any(channels):
+        body["channel"] = channels
+    if any(radios):
+        body["radio"] = radios
+    return body
+
+# Encode a payload or batch for posting. Returns the body and the headers that
+# describe it.
+def encode_upload(body, upload_format="json", compression="none"):
+    headers = {"Content-Type": upload_content_types[upload_format]}
+    if upload_format == "msgpack":
+        data = msgpack.packb(encode_columnar(body))
+    else:
+        if upload_format == "columnar":
+            body = encode_columnar(body)
+        data = json.dumps(body, separators=(",", ":")).encode()
+
+    compressor = upload_compressors[compression]
+    if compressor is not None:
+        data = compressor(data)
+        headers["Content-Encoding"] = compression
+    return data, headers
+
+
+# Edge filter settings for one node. Times are in milliseconds.
+FilterSettings = collections.namedtuple(
+    "FilterSettings", ["deadband", "min_interval", "max_interval", "window", "aggregate"]
+)
+
+filter_aggregates = {
+    "mean": lambda values: sum(values) / len(values),
+    "min": min,
+    "max": max,
+}
+
+# Sections named "Node <address>" override the edge filter for that node
+node_section_prefix = "Node "
+
+# Read the filter settings from a config section, falling back to fallback for
+# anything it doesn't set. Returns None when the filter does nothing.
+def parse_filter_settings(section, prefix="", fallback=None):
+    def get_ms(key, default):
+        return int(section.getfloat(prefix + key, default / 1000) * 1000)
+
+    fallback = fallback or FilterSettings(0, 0, 0, 0, "mean")
+    settings = FilterSettings(
+        deadband=section.getfloat(prefix + "deadband", fallback.deadband),
+        min_interval=get_ms("min_interval", fallback.min_interval),
+        max_interval=get_ms("max_interval", fallback.max_interval),
+        window=get_ms("window", fallback.window),
+        aggregate=section.get(prefix + "aggregate", fallback.aggregate).strip(),
+    )
+    if settings.aggregate not in filter_aggregates:
+        raise ValueError("Unknown filter aggregate: {}".format(settings.aggregate))
+    if not (settings.deadband or settings.min_interval or settings.window):
+        return None
+    return settings
 
-def serial_reader():
-    # Standard byte offset for Zigbee/DigiMesh packet
-    standard_offset = 3
-    #Standard byte offset for Zigbee/DigiMesh Checksum
-    checksum_offset = 1
-    #minimum packet size with one byte of data (for 0x90 packet)
-    min_packet_size = 17
-    #byte of start delimiter
-    delimiter = b"\x7E"
+def parse_config():
+    # get the server urls and strip the whilespace
+    server_urls = get_server_urls(config["ServerConf"]["server_url"], main_route)
+    api_keys = get_api_keys(config["ServerConf"]["api_key"])
+    upload_formats = get_upload_settings("upload_format", "json", upload_content_types)
+    compressions = get_upload_settings("upload_compression", "none", upload_compressors)
+
+    default_filter = parse_filter_settings(config["ServerConf"], "filter_")
+    node_filters = {
+        name[len(node_section_prefix):].strip().upper(): parse_filter_settings(config[name], fallback=default_filter)
+        for name in config.sections() if name.startswith(node_section_prefix)
+    }
 
-    buffer = b""  # Buffer to hold incoming data
+    destinations = []
+    for i in range(len(server_urls)):
+        # if only one api key is given, use it
+        api_key = api_keys[i] if len(api_keys) > 1 else api_keys[0]
+        upload_format = upload_formats[i] if len(upload_formats) > 1 else upload_formats[0]
+        compression = compressions[i] if len(compressions) > 1 else compressions[0]
+        destinations.append(Destination(
+            server_urls[i], api_key, get_headers(api_key), get_batch_url(server_urls[i]), get_http_session(server_urls[i]),
+            upload_format, compression,
+        ))
+
+    # Payloads are sent in batches of up to batch_size, waiting at most batch_wait
+    # milliseconds for a batch to fill. A batch_size of 1 posts every payload on its own.
+    return ParsedConfig(
+        destinations=tuple(destinations),
+        batch_size=max(1, config["ServerConf"].getint("batch_size", 1)),
+        batch_wait=config["ServerConf"].getint("batch_wait", 200),
+        queue_size=config["ServerConf"].getint("destination_queue_size", 10000),
+        pool_size=config["ServerConf"].getint("http_pool_size", 4),
+        io_sample_rate=config["ServerConf"].getint("io_sample_rate", 1000),
+        edge_filter=default_filter,
+        node_filters=node_filters,
+    )
 
+def get_parsed_config():
+    if parsed_config is None:
+        return reload_parsed_config()
+    return parsed_config
+
+# Parse the configuration again and swap in the result. An unchanged
+# configuration keeps the existing snapshot so nothing gets rebuilt.
+def reload_parsed_config():
+    global parsed_config
+    with parsed_config_lock:
+        new_config = parse_config()
+        if new_config != parsed_config:
+            parsed_config = new_config
+        return parsed_config
+
+# Reload configfile.ini whenever it changes on disk, so edits take effect
+# without restarting the service
+def config_watcher():
+    global config
+    poll_interval = config["ServerConf"].getfloat("config_poll_interval", 2)
+    last_modified = os.path.getmtime(configLocation)
     while True:
+        time.sleep(poll_interval)
         try:
-            # Read incoming data one byte at a time
-            new_data = port.read(1)
-            if not new_data:
-                time.sleep(0.5) #wait half a second for new data
+            modified = os.path.getmtime(configLocation)
+            if modified == last_modified:
                 continue
-            buffer += new_data
-
-            while buffer:
+            last_modified = modified
+            # Read into a new parser so removed keys and sections go away too,
+            # keeping the old one if the new file can't be used
+            new_config = configparser.ConfigParser()
+            new_config.read(configLocation)
+            previous_config = config
+            config = new_config
+            try:
+                reload_parsed_config()
+            except Exception:
+                config = previous_config
+                raise
+            logger.info("Configuration reloaded from %s", configLocation)
+        except Exception as e:
+            logger.error("Exception reloading configuration: %s", e)
+
+
+# XBee API frame types
+FRAME_AT_COMMAND_RESPONSE = 0x88
+FRAME_MODEM_STATUS = 0x8A
+FRAME_TRANSMIT_STATUS = 0x8B
+FRAME_RECEIVE_PACKET = 0x90
+FRAME_EXPLICIT_RX_INDICATOR = 0x91
+FRAME_IO_SAMPLE_INDICATOR = 0x92
+FRAME_NODE_IDENTIFICATION = 0x95
+
+
+# Escape byte used by API mode 2 (AP=2)
+ESCAPE = 0x7D
+
+
+# Undo API mode 2 escaping. Instead of walking the data byte by byte, split it on
+# the escape byte so every part after the first starts with an escaped byte that
+# only needs XORing with 0x20. A trailing escape with nothing after it is dropped.
+def unescape_api_data(data):
+    parts = data.split(b"\x7d")
+    if len(parts) == 1:
+        return data
+    unescaped = bytearray(parts[0])
+    for part in parts[1:]:
+        if part:
+            unescaped.append(part[0] ^ 0x20)
+            unescaped += part[1:]
+    return unescaped
+
+
+# Receive times are taken from the monotonic clock and anchored to the wall
+# clock once at startup, so they are cheap to take and never jump when the
+# system time is stepped
+clock_anchor_ns = time.time_ns() - time.monotonic_ns()
+
+# Nanoseconds since the epoch, for the moment a read returned
+def receive_time_ns():
+    return time.monotonic_ns() + clock_anchor_ns
+
+
+# Incremental decoder for XBee API frames.
+# Bytes are fed in as they come off the serial port and every complete frame is
+# handed to the handler registered for its frame type as
+# handler(frame, length, radio, received_at), where frame is a memoryview from
+# the frame type byte through the checksum, length is the frame data length from
+# the header, radio names the coordinator the decoder reads from and received_at
+# is when the read holding the frame's first byte returned, in epoch
+# milliseconds. Partial frames stay buffered until the rest of them arrives.
+# The view is only valid during the call, so handlers must copy anything they
+# want to keep.
+# Set escaped for radios running in API mode 2 (AP=2).
+class XBeeFrameDecoder:
+    # byte of start delimiter
+    delimiter = 0x7E
+    # start delimiter plus the 16 bit big endian length
+    header_length = 3
+    # anything longer than this is treated as a corrupt length field
+    max_frame_length = 1024
+    length_field = struct.Struct(">H")
+
+    def __init__(self, escaped=False, radio=None):
+        self.escaped = escaped
+        self.radio = radio
+        self.buffer = bytearray()
+        # Receive times of the bytes left over from earlier reads and of this read
+        self.carried_bytes = 0
+        self.carried_received_at = 0
+        self.chunk_received_at = 0
+        self.handlers = {}
+        self.default_handler = None
+
+    # Register the handler for a frame type, replacing any previous one
+    def register(self, frame_type, handler):
+        self.handlers[frame_type] = handler
+
+    # Add newly read bytes and dispatch every frame that is now complete.
+    # received_ns is when the read returned, in ns since the epoch.
+    def feed(self, data, received_ns=None):
+        if received_ns is None:
+            received_ns = receive_time_ns()
+        self.chunk_received_at = received_ns // 1000000
+        if not self.buffer:
+            self.carried_received_at = self.chunk_received_at
+        self.carried_bytes = len(self.buffer)
+        self.buffer += data
+        if self.escaped:
+            self.decode_escaped()
+        else:
+            self.decode_unescaped()
+
+    # Receive time of the read that brought in the buffered byte at pos
+    def received_at(self, pos):
+        return self.carried_received_at if pos < self.carried_bytes else self.chunk_received_at
+
+    # Drop everything before pos once the buffer has been walked, remembering
+    # when the partial frame that is left started arriving
+    def compact(self, pos, decoded_bytes):
+        self.carried_received_at = self.received_at(pos)
+        del self.buffer[:pos]
+        if pos > decoded_bytes:
+            resync_bytes_discarded.inc(pos - decoded_bytes)
+
+    # API mode 1: frames are delimited by their length header alone
+    def decode_unescaped(self):
+        buffer = self.buffer
+
+        # Walk the buffer with an offset and only compact it once per feed
+        pos = 0
+        decoded_bytes = 0
+        view = memoryview(buffer)
+        try:
+            while True:
                 # Find the index of the next start delimiter
-                start_idx = buffer.find(delimiter)
-
+                start_idx = buffer.find(self.delimiter, pos)
                 if start_idx == -1:
-                    buffer = b""  # Discard incomplete packets
+                    pos = len(buffer)  # Nothing left that can start a frame
                     break
-                if start_idx > 0:
-                    buffer = buffer[start_idx:]
+                pos = start_idx
 
-                # Check and see if this packet meets its minimum size with one byte of data
-                if len(buffer) < min_packet_size: 
+                if len(buffer) - pos < self.header_length:
+                    break
+                (length,) = self.length_field.unpack_from(buffer, pos + 1)
+                if length == 0 or length > self.max_frame_length:
+                    pos += 1  # Not a real delimiter, resync on the next one
+                    continue
+
+                # Wait until the frame data and checksum are all here
+                end_idx = pos + self.header_length + length + 1
+                if end_idx > len(buffer):
                     break
 
-                # Extract MSB and LSB to calculate packet length
-                msb = int(buffer[1:2].hex(), 16)
-                lsb = int(buffer[2:3].hex(), 16)
-                packet_length = (msb << 8) | lsb
-                total_packet_length = packet_length + standard_offset + checksum_offset
+                with view[pos + self.header_length:end_idx] as frame:
+                    if not self.process_frame(frame, length, self.received_at(pos)):
+                        pos += 1
+                        continue
+                decoded_bytes += end_idx - pos
+                pos = end_idx
+        finally:
+            view.release()
+            self.compact(pos, decoded_bytes)
+
+    # API mode 2: a raw 0x7E can only ever be a start delimiter, so each frame is
+    # everything between one delimiter and the next and is unescaped in one go
+    def decode_escaped(self):
+        buffer = self.buffer
+
+        pos = 0
+        decoded_bytes = 0
+        try:
+            while True:
+                start_idx = buffer.find(self.delimiter, pos)
+                if start_idx == -1:
+                    pos = len(buffer)
+                    break
+                pos = start_idx
+
+                next_idx = buffer.find(self.delimiter, pos + 1)
+                end_idx = len(buffer) if next_idx == -1 else next_idx
+                frame_data = unescape_api_data(buffer[pos + 1:end_idx])
+
+                length = None
+                if len(frame_data) >= self.header_length - 1:
+                    (length,) = self.length_field.unpack_from(frame_data)
+                    if length == 0 or length > self.max_frame_length:
+                        length = None
+                        if next_idx == -1:
+                            pos = len(buffer)
+                            break
+
+                # Wait for more data unless the next frame has already started
+                if length is None or len(frame_data) < length + self.header_length:
+                    if next_idx == -1:
+                        break
+                    pos = next_idx  # Truncated frame, skip to the next one
+                    continue
+
+                with memoryview(frame_data)[self.header_length - 1:length + self.header_length] as frame:
+                    if self.process_frame(frame, length, self.received_at(pos)):
+                        decoded_bytes += end_idx - pos
+                # Anything after the frame and before the next delimiter is noise
+                pos = end_idx
+        finally:
+            self.compact(pos, decoded_bytes)
+
+    # Validate the checksum of a complete frame and dispatch it if it's good
+    def process_frame(self, frame, length, received_at):
+        if not validate_checksum(frame):
+            logger.warning("Checksum is invalid. Ignoring the data.")
+            checksum_failures.inc()
+            return False
+        frames_decoded.inc(labels=FRAME_TYPE_LABELS[frame[0]])
+        self.dispatch(frame, length, received_at)
+        return True
+
+    # Hand a complete, checksum validated frame to its handler
+    def dispatch(self, frame, length, received_at):
+        handler = self.handlers.get(frame[0], self.default_handler)
+        if handler is None:
+            return
+        try:
+            handler(frame, length, self.radio, received_at)
+        except Exception as e:
+            logger.error("Exception handling frame type %#04x: %s", frame[0], e)
+
+
+# Build a decoder with the handlers for every frame type the hub understands
+def create_frame_decoder(escaped=False, radio=None):
+    decoder = XBeeFrameDecoder(escaped, radio)
+    decoder.register(FRAME_RECEIVE_PACKET, parse_receive_data_packet)
+    decoder.register(FRAME_EXPLICIT_RX_INDICATOR, parse_explicit_rx_packet)
+    decoder.register(FRAME_IO_SAMPLE_INDICATOR, parse_io_sample_packet)
+    decoder.register(FRAME_NODE_IDENTIFICATION, parse_node_identification_packet)
+    decoder.register(FRAME_MODEM_STATUS, parse_modem_status_packet)
+    decoder.register(FRAME_AT_COMMAND_RESPONSE, parse_at_command_response_packet)
+    decoder.register(FRAME_TRANSMIT_STATUS, parse_transmit_status_packet)
+    decoder.default_handler = parse_unknown_packet
+    return decoder
+
+
+# Serial transports. Anything with read(size), close() and a timeout attribute
+# (seconds a read waits for data) can feed the decoder: pyftdi and pyserial ports
+# as they are, plus the TCP and file transports below.
+
+# Reads from a TCP socket, e.g. a serial to Ethernet bridge or ser2net.
+# The connection is (re)opened on the next read after it drops.
+class SocketTransport:
+    def __init__(self, host, port, timeout=0.05):
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+
+    def read(self, size=1):
+        if self.sock is None:
+            self.sock = socket.create_connection(self.address, timeout=5)
+        self.sock.settimeout(self.timeout)
+        try:
+            data = self.sock.recv(size)
+        except socket.timeout:
+            return b""
+        if not data:
+            # The other end closed the connection
+            self.close()
+            raise ConnectionError("Connection to {}:{} closed".format(*self.address))
+        return data
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+# Reads from a file or named pipe. At the end of the file (or with no writer on
+# the pipe) reads wait out the timeout and return nothing.
+class FileTransport:
+    def __init__(self, path, timeout=0.05):
+        self.path = path
+        self.timeout = timeout
+        # Non-blocking so opening a pipe doesn't wait for a writer
+        self.fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
+
+    def read(self, size=1):
+        readable, _, _ = select.select([self.fd], [], [], self.timeout)
+        data = os.read(self.fd, size) if readable else b""
+        if readable and not data:
+            time.sleep(self.timeout)
+        return data
+
+    def close(self):
+        os.close(self.fd)
+
+# Open the transport named by serial_port_url:
+#   ftdi://ftdi:232:/1              FTDI device through pyftdi
+#   tcp://host:port                 TCP socket
+#   file:///path/to/capture         file or named pipe
+#   anything else                   serial device path or URL through pyserial,
+#                                   e.g. /dev/ttyUSB0, COM3 or rfc2217://host:port
+def open_serial_port(url, baud_rate):
+    scheme = urlsplit(url).scheme
+    if scheme == "ftdi":
+        if pyftdi is None:
+            raise RuntimeError("ftdi:// serial ports need pyftdi, install it with: pip install pyftdi")
+        return pyftdi.serialext.serial_for_url(url, baudrate=baud_rate)
+    if scheme == "tcp":
+        address = urlsplit(url)
+        return SocketTransport(address.hostname, address.port)
+    if scheme == "file":
+        return FileTransport(urlsplit(url).path)
+    if serial is None:
+        raise RuntimeError("Serial devices need pyserial, install it with: pip install pyserial")
+    return serial.serial_for_url(url, baudrate=baud_rate)
+
+
+
+# Raw serial capture. Every chunk read from the port is written with its receive
+# time to gzip compressed files in capture_path, starting a new file after
+# capture_max_bytes and keeping the newest capture_max_files. The writing happens
+# on its own thread; if it falls behind, chunks are left out of the capture
+# rather than holding up the serial reader.
+capture_record = struct.Struct(">QI")  # receive time in ns since the epoch, chunk length
+capture_pattern = "capture-*.xbcap.gz"
+
+class FrameCapture(threading.Thread):
+    def __init__(self, directory, max_bytes, max_files, queue_size):
+        super().__init__(daemon=True)
+        self.directory = Path(directory)
+        self.directory.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.max_files = max_files
+        self.chunks = queue.Queue(maxsize=queue_size)
+        self.file = None
+        self.file_bytes = 0
+
+    def write(self, data, timestamp_ns):
+        try:
+            self.chunks.put_nowait((timestamp_ns, data))
+        except queue.Full:
+            capture_chunks_dropped.inc()
+
+    def rotate(self):
+        if self.file is not None:
+            self.file.close()
+        name = datetime.datetime.now(datetime.timezone.utc).strftime("capture-%Y%m%d-%H%M%S-%f.xbcap.gz")
+        self.file = gzip.open(self.directory / name, "wb")
+        self.file_bytes = 0
+
+        if self.max_files > 0:
+            for old_file in sorted(self.directory.glob(capture_pattern))[:-self.max_files]:
+                old_file.unlink()
+
+    def run(self):
+        while True:
+            try:
+                timestamp_ns, data = self.chunks.get(timeout=1)
+            except queue.Empty:
+                # Flush while the port is quiet so a crash loses as little as possible
+                if self.file is not None:
+                    self.file.flush()
+                continue
 
-                # Check if there's enough data for the complete packet
-                if (
-                    len(buffer) < total_packet_length
-                ):
+            try:
+                if self.file is None or self.file_bytes >= self.max_bytes:
+                    self.rotate()
+                self.file.write(capture_record.pack(timestamp_ns, len(data)))
+                self.file.write(data)
+                self.file_bytes += capture_record.size + len(data)
+            except Exception as e:
+                logger.error("Exception writing capture: %s", e)
+                time.sleep(1)
+
+def open_frame_capture(subdirectory=""):
+    capture_path = config["ServerConf"].get("capture_path", "").strip()
+    if not capture_path:
+        return None
+    capture = FrameCapture(
+        source_dir / capture_path / subdirectory,
+        config["ServerConf"].getint("capture_max_bytes", 10000000),
+        config["ServerConf"].getint("capture_max_files", 10),
+        config["ServerConf"].getint("capture_queue_size", 1000),
+    )
+    capture.start()
+    return capture
+
+# Read (receive time in ns, chunk) records back from capture files in order.
+# The files are decompressed as a stream, so one cut short by a crash still
+# gives every complete record written before it.
+def read_capture(paths):
+    for path in paths:
+        decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        buffer = bytearray()
+        with open(path, "rb") as capture_file:
+            for compressed in iter(lambda: capture_file.read(65536), b""):
+                try:
+                    buffer += decompressor.decompress(compressed)
+                except zlib.error:
                     break
 
-                print("New Packet Received")
+                offset = 0
+                while len(buffer) - offset >= capture_record.size:
+                    timestamp_ns, length = capture_record.unpack_from(buffer, offset)
+                    end = offset + capture_record.size + length
+                    if end > len(buffer):
+                        break
+                    yield timestamp_ns, bytes(buffer[offset + capture_record.size:end])
+                    offset = end
+                del buffer[:offset]
+
+# Plays capture files back as a serial transport. Chunks are released as far
+# apart as they were received divided by speed, or as fast as they are read with
+# a speed of 0. finished is set once everything has been read.
+class ReplayTransport:
+    def __init__(self, paths, speed=1.0, timeout=0.05):
+        self.records = read_capture(paths)
+        self.speed = speed
+        self.timeout = timeout
+        self.pending = b""
+        self.next_record = None
+        self.first_timestamp = None
+        self.start_time = None
+        self.finished = threading.Event()
+
+    def read(self, size=1):
+        if not self.pending:
+            if self.next_record is None:
+                self.next_record = next(self.records, None)
+                if self.next_record is None:
+                    self.finished.set()
+                    time.sleep(self.timeout)
+                    return b""
+
+            timestamp_ns, data = self.next_record
+            if self.first_timestamp is None:
+                self.first_timestamp = timestamp_ns
+                self.start_time = time.monotonic()
+            if self.speed > 0:
+                wait = self.start_time + (timestamp_ns - self.first_timestamp) / 1e9 / self.speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(min(wait, self.timeout))
+                    if wait > self.timeout:
+                        return b""
+            self.pending = data
+            self.next_record = None
+
+        data = self.pending[:size]
+        self.pending = self.pending[size:]
+        return data
+
+    def close(self):
+        self.records.close()
+
+
+# A coordinator radio: its serial transport, the name its payloads are tagged
+# with (None when there is only one radio) and its capture writer, if any
+SerialSource = collections.namedtuple("SerialSource", ["radio", "port", "capture"])
+
+# Open every port in the comma separated serial_port_url. baud_rate is either
+# one rate for all of them or a comma separated rate per port. With several
+# radios each one's capture goes in its own radio<n> directory.
+def open_serial_sources():
+    urls = [url.strip() for url in config["ServerConf"].get("serial_port_url", "ftdi://ftdi:232:/1").split(",") if url.strip()]
+    baud_rates = [int(rate) for rate in config["ServerConf"].get("baud_rate", "115200").split(",")]
+
+    sources = []
+    for i, url in enumerate(urls):
+        baud_rate = baud_rates[i] if len(baud_rates) > 1 else baud_rates[0]
+        if len(urls) > 1:
+            sources.append(SerialSource(url, open_serial_port(url, baud_rate), open_frame_capture("radio{}".format(i + 1))))
+        else:
+            sources.append(SerialSource(None, open_serial_port(url, baud_rate), open_frame_capture()))
+    return sources
+
+
+# How many bytes to ask the port for. pyserial and pyftdi ports only return
+# early once that many bytes have arrived, so ask for what is already waiting
+# (or a single byte when nothing is, which returns as soon as one arrives), up
+# to read_chunk_size. Transports without in_waiting return whatever they have.
+def get_read_size(port, read_chunk_size):
+    in_waiting = getattr(port, "in_waiting", None)
+    if in_waiting is None:
+        return read_chunk_size
+    return min(max(1, in_waiting), read_chunk_size)
 
-                # Extract and process the complete packet
-                end_packet_idx = total_packet_length + 1
-                complete_packet = buffer[:end_packet_idx]
-                buffer = buffer[end_packet_idx:] # buffer will be cleared if this is the only packet
+def serial_reader(source):
+    port, capture = source.port, source.capture
 
-                # Extract the frame type (4th byte)
-                frame_type = complete_packet[3]
+    # Drain up to this many bytes per read; the port timeout bounds how long
+    # a read blocks when the radio is idle instead of a fixed sleep
+    read_chunk_size = config["ServerConf"].getint("read_chunk_size", 4096)
+    port.timeout = config["ServerConf"].getfloat("read_timeout", 0.05)
 
-                if frame_type == 0x90:
-                    parse_receive_data_packet(complete_packet[3:], packet_length)
-                elif frame_type == 0x92:
-                    parse_io_sample_packet(complete_packet[3:], packet_length)
+    # API mode 2 (AP=2) escapes control bytes inside frames
+    decoder = create_frame_decoder(config["ServerConf"].getint("api_mode", 1) == 2, source.radio)
+
+    while True:
+        try:
+            # Read everything currently available on the port in one call
+            new_data = port.read(get_read_size(port, read_chunk_size))
+            if new_data:
+                received_ns = receive_time_ns()
+                serial_bytes_read.inc(len(new_data))
+                if capture is not None:
+                    capture.write(new_data, received_ns)
+                decoder.feed(new_data, received_ns)
 
         except Exception as e:
-            print("Exception in serial_reader:", e)
+            logger.error("Exception in serial_reader: %s", e)
             time.sleep(1)
                 # # Extract the 64-bit source address (next 8 bytes)
                 # source_address_64 = complete_packet[4:12]
@@ -191,108 +1116,267 @@ def serial_reader():
                 # else:
                 #     print("Unknown frame type:", hex(frame_type))
 
+# Convert received RF data to ASCII, dropping anything that isn't
+def decode_received_data(received_data):
+    return bytes(received_data).decode("ascii", errors="ignore")
+
 # Parse an 0x90 packet, past the delimiter, length, and frame type bytes
-def parse_receive_data_packet(packet, length):
-    print("Received Packet 0x90:", packet.hex())
+def parse_receive_data_packet(packet, length, radio, received_at):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received Packet 0x90: %s", packet.hex())
     # Extract the 64-bit source address (next 8 bytes)
     source_address_64 = packet[1:9]
 
-    # Extract the 16-bit source network address (next 2 bytes)
-    source_address_16 = packet[9:11]
+    # The received data runs from after the receive options up to the checksum
+    received_data_ascii = decode_received_data(packet[12:length])
 
-    # Extract the receive options (next 1 byte)
-    receive_options = packet[11]
+    add_json_payload(source_address_64.hex().upper(), float(received_data_ascii), received_at, radio=radio)
 
-    # Calculate the number of bytes for the received data
-    received_data_length = (
-        length - 12
-    )
+# Parse an 0x91 packet, past the delimiter, length, and frame type bytes
+def parse_explicit_rx_packet(packet, length, radio, received_at):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received Packet 0x91: %s", packet.hex())
+    # Extract the 64-bit source address (next 8 bytes)
+    source_address_64 = packet[1:9]
 
-    # Extract the received data
-    received_data = packet[12 : 12 + received_data_length]
+    # Same as 0x90 but with endpoints, cluster ID and profile ID before the options
+    received_data_ascii = decode_received_data(packet[18:length])
 
-    # Convert received data from hex to ASCII
-    received_data_ascii = bytes.fromhex(received_data.hex()).decode(
-        "utf-8", errors="replace"
-    )
-    received_data_ascii = "".join(
-        char for char in received_data_ascii if char.isascii()
-    )
+    add_json_payload(source_address_64.hex().upper(), float(received_data_ascii), received_at, radio=radio)
 
-    # Validate the checksum
-    checksum_valid = validate_checksum(packet)
-    if checksum_valid:
-        print("Checksum is valid.")
-        add_json_payload(str(source_address_64.hex()).upper(), float(received_data_ascii))
-    else:
-        print("Checksum is invalid. Ignoring the data.")
+# Analog sample mask bits and the channel each one reports
+ANALOG_CHANNELS = ((0, "AD0"), (1, "AD1"), (2, "AD2"), (3, "AD3"), (7, "SUPPLY"))
+# The first analog input is what sensors have always reported, so its payloads
+# carry no channel name
+PRIMARY_CHANNEL = "AD0"
 
-# Parse an 0x92 packet, past the delimiter, length, and frame type bytes
-def parse_io_sample_packet(packet, length):
-    print("Received Packet 0x92:", packet.hex())
+# Decode every sample in an 0x92 packet into (sample index, channel, value) records.
+# Each sample holds the 16 bit digital pin states when any digital pins are enabled,
+# followed by a 16 bit reading for each enabled analog channel in mask order.
+def parse_io_samples(packet, length):
     # reference voltage of 2.5 volts
     voltage_ref = 2.5
     c_factor = 1023
 
-    # extract the 64 bit source address
-    source_address_64 = packet[1:9]
+    num_samples = packet[12]
+    digital_sample_mask = int.from_bytes(packet[13:15], "big")
+    analog_sample_mask = packet[15]
+
+    digital_pins = [pin for pin in range(16) if digital_sample_mask >> pin & 1]
+    analog_channels = [name for bit, name in ANALOG_CHANNELS if analog_sample_mask >> bit & 1]
+
+    sample_size = (2 if digital_pins else 0) + 2 * len(analog_channels)
+    if sample_size == 0:
+        return []
+
+    # Samples run from after the masks up to the checksum
+    available_samples = (length - 16) // sample_size
+    if available_samples < num_samples:
+        logger.warning("Packet is missing samples, only %d of %d present", available_samples, num_samples)
+        num_samples = available_samples
+
+    records = []
+    offset = 16
+    for sample_index in range(num_samples):
+        if digital_pins:
+            digital_samples = int.from_bytes(packet[offset:offset + 2], "big")
+            offset += 2
+            for pin in digital_pins:
+                records.append((sample_index, "DIO{}".format(pin), digital_samples >> pin & 1))
+
+        for channel in analog_channels:
+            sample_value = int.from_bytes(packet[offset:offset + 2], "big")
+            offset += 2
+            if channel == "SUPPLY":
+                # Supply voltage is reported in millivolts
+                records.append((sample_index, channel, sample_value / 1000))
+            else:
+                records.append((sample_index, channel, (sample_value / c_factor) * voltage_ref))
 
-    # Extract the 8 bit receive options
-    receive_options = packet[11]
+    return records
 
-    # Extrack the number of sample, and check that it is 1
-    num_samples = packet[12]
-    if num_samples != 0x01:
-        print("Packet contains more than one sample! Aborting")
-        return;
-
-    #Extract the 16 bit digital sample mask, and check that it is 0
-    digital_sample_mask = packet[13:15]
-    if int(digital_sample_mask.hex(), 16) > 0:
-        print("Unsupported Digital Sample Provided! Aborting")
-        return
+# Parse an 0x92 packet, past the delimiter, length, and frame type bytes
+def parse_io_sample_packet(packet, length, radio, received_at):
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Received Packet 0x92: %s", packet.hex())
 
-    #Extract the 8 bit analog sample mask
-    analog_sample_mask = packet[15]
+    # extract the 64 bit source address
+    source_address_64 = packet[1:9].hex().upper()
 
-    #Extract the 16 bit sample value
-    sample_value = packet[16:18]
-    act_sample_value = (int(sample_value.hex(), 16) / c_factor) * voltage_ref
+    records = parse_io_samples(packet, length)
+    if not records:
+        logger.warning("Packet contains no enabled channels! Ignoring")
+        return
 
-    # Validate the checksum
-    checksum_valid = validate_checksum(packet)
-    if checksum_valid:
-        print("Checksum is valid.")
-        add_json_payload(str(source_address_64.hex()).upper(), act_sample_value)
-    else:
-        print("Checksum is invalid. Ignoring the data.")
+    # Batched samples (IR with IC or sleep) were taken io_sample_rate ms apart,
+    # oldest first, and all arrive together in this frame
+    sample_rate = get_parsed_config().io_sample_rate
+    last_sample = records[-1][0]
+
+    for sample_index, channel, value in records:
+        add_json_payload(
+            source_address_64,
+            value,
+            received_at,
+            channel=None if channel == PRIMARY_CHANNEL else channel,
+            age_ms=(last_sample - sample_index) * sample_rate,
+            radio=radio,
+        )
+
+# Parse an 0x95 packet, past the delimiter, length, and frame type bytes
+def parse_node_identification_packet(packet, length, radio, received_at):
+    # The node identifier string starts after the remote addresses and is null terminated
+    node_identifier = decode_received_data(packet[22:length]).split("\0", 1)[0]
+    logger.info("Node Identified: %s %s", packet[1:9].hex().upper(), node_identifier)
+
+# Parse an 0x8A packet, past the delimiter, length, and frame type bytes
+def parse_modem_status_packet(packet, length, radio, received_at):
+    logger.info("Modem Status: %#04x", packet[1])
+
+# Parse an 0x88 packet, past the delimiter, length, and frame type bytes
+def parse_at_command_response_packet(packet, length, radio, received_at):
+    logger.info("AT Command Response: %s Status: %#04x", decode_received_data(packet[2:4]), packet[4])
+
+# Parse an 0x8B packet, past the delimiter, length, and frame type bytes
+def parse_transmit_status_packet(packet, length, radio, received_at):
+    logger.debug("Transmit Status: %#04x", packet[5])
+
+# Report frame types that have no handler registered
+def parse_unknown_packet(packet, length, radio, received_at):
+    logger.info("Unknown frame type: %#04x", packet[0])
+
+
+# Per node edge filter, applied to readings before they are queued so slowly
+# changing sensors don't cost a POST and an Influx write every second. For each
+# node, channel and radio:
+#   window        readings are collected into windows of this many ms and only
+#                 their mean, min or max (aggregate) goes on, stamped with the
+#                 start of the window
+#   deadband      a value within this much of the last one forwarded is dropped
+#   min_interval  nothing is forwarded sooner than this after the last value
+#   max_interval  a value is always forwarded this long after the last one,
+#                 so a steady sensor still shows up
+class FilterState:
+    def __init__(self, settings, template):
+        self.settings = settings
+        self.template = template
+        self.last_value = None
+        self.last_time = None
+        self.window_start = None
+        self.window_values = []
+
+class EdgeFilter:
+    # How often windows left open by nodes that went quiet are closed, in ms
+    flush_interval = 1000
+
+    def __init__(self):
+        self.states = {}
+        self.lock = threading.Lock()
+        self.next_flush = 0
+
+    # Returns the payloads to queue for a new reading: none, the reading itself,
+    # or the aggregate of a window the reading has just closed
+    def add(self, payload):
+        parsed = get_parsed_config()
+        settings = parsed.node_filters.get(payload["source_address_64"], parsed.edge_filter)
+        if settings is None:
+            return [payload]
+
+        key = (payload["source_address_64"], payload.get("channel"), payload.get("radio"))
+        with self.lock:
+            state = self.states.get(key)
+            if state is None:
+                state = self.states[key] = FilterState(settings, payload)
+            state.settings = settings
+
+            timestamp = payload["date_time"]
+            if not settings.window:
+                if self.should_forward(state, payload["data"], timestamp):
+                    return [payload]
+                payloads_filtered.inc()
+                return []
+
+            forwarded = []
+            window_start = timestamp - timestamp % settings.window
+            if state.window_values and window_start > state.window_start:
+                forwarded = self.close_window(state)
+            if not state.window_values:
+                state.window_start = window_start
+                state.template = payload
+            state.window_values.append(payload["data"])
+            payloads_filtered.inc()
+            return forwarded
+
+    # Close the windows of nodes that have stopped sending, at most once per
+    # flush_interval, and return their aggregates. close_all closes every open
+    # window straight away, for when no more readings are coming.
+    def flush(self, close_all=False):
+        now = receive_time_ns() // 1000000
+        if now < self.next_flush and not close_all:
+            return []
+        self.next_flush = now + self.flush_interval
+
+        forwarded = []
+        with self.lock:
+            for state in self.states.values():
+                if state.window_values and (close_all or now >= state.window_start + state.settings.window):
+                    forwarded.extend(self.close_window(state))
+        return forwarded
+
+    def close_window(self, state):
+        value = filter_aggregates[state.settings.aggregate](state.window_values)
+        state.window_values = []
+        if not self.should_forward(state, value, state.window_start):
+            return []
+        return [dict(state.template, date_time=state.window_start, data=value)]
+
+    def should_forward(self, state, value, timestamp):
+        settings = state.settings
+        if state.last_time is not None:
+            elapsed = timestamp - state.last_time
+            if not (settings.max_interval and elapsed >= settings.max_interval):
+                if settings.min_interval and elapsed < settings.min_interval:
+                    return False
+                if settings.deadband and abs(value - state.last_value) <= settings.deadband:
+                    return False
+        state.last_value = value
+        state.last_time = timestamp
+        return True
+
+edge_filter = EdgeFilter()
+
+# Queue the readings the edge filter has let through, or closed windows of
+def queue_filtered_payloads(payloads):
+    for payload in payloads:
+        logger.debug("Queued payload %s", payload)
+        json_payload_queue.put(payload)
+        payloads_queued.inc()
 
 
 # add json payload to the queue
-def add_json_payload(source_address_64, data):
-    current_time = datetime.datetime.now(datetime.timezone.utc)
-    epoch_time = round(current_time.timestamp(), 3) * 1000
-    
+# received_at is when the frame arrived in epoch milliseconds, age_ms backdates
+# readings that were sampled before the frame arrived, channel names the input
+# for anything other than the primary analog channel, and radio names the
+# coordinator the frame came in on when there are several
+def add_json_payload(source_address_64, data, received_at, channel=None, age_ms=0, radio=None):
     # Construct JSON payload
     payload = {
         "source_address_64": source_address_64,
-        "date_time": epoch_time,
+        "date_time": received_at - age_ms,
         "data": data,
     }
+    if channel is not None:
+        payload["channel"] = channel
+    if radio is not None:
+        payload["radio"] = radio
 
-    print(payload)
-
-    json_payload_queue.put(payload)
+    queue_filtered_payloads(edge_filter.add(payload))
 
 
 
 # Create a thread-safe queue for JSON payloads
 json_payload_queue = queue.Queue()
 
-# Create a separate thread for serial reading
-serial_thread = threading.Thread(target=serial_reader)
-serial_thread.daemon = True
-serial_thread.start()
 
 @app.route("/", methods=["GET", "POST"])
 def index():
@@ -301,6 +1385,7 @@ def index():
         config["ServerConf"]["server_url"] = request.form["server_url"]
         config["ServerConf"]["api_key"] = request.form["api_key"].replace("%", "%%")
         write_file()  # Save the updated configuration to the file
+        reload_parsed_config()  # and start using it straight away
         return "Configuration updated successfully."
     
     # Render the configuration form
@@ -329,18 +1414,14 @@ def check_auth_connection():
             current_server_url = server_urls[i]
             current_api_key = api_keys[i] if len(api_keys) > 1 else api_keys[0]
 
-            headers = {
-                    "Authorization": f"{current_api_key}",
-                    "Content-Type": "application/json",
-                    "Content-Encoding": "utf-8"
-            }
+            headers = get_headers(current_api_key)
             # Check if both server URL and API key are provided
             if current_server_url and current_api_key:
                 try:
                     # Make a POST request to the receive server's auth_check route
-                    response = requests.post(current_server_url, json=payload, headers=headers)
+                    response = get_http_session(current_server_url).post(current_server_url, json=payload, headers=headers)
 
-                    print("POST Status Code:", response.status_code)
+                    logger.info("POST Status Code: %s", response.status_code)
 
                     if response.status_code == 200 or response.status_code == 204:
                         result = {"message": 'URL #{idx}: Authorization and Connection are OK!'.format(idx=i+1)}
@@ -359,77 +1440,910 @@ def check_auth_connection():
         return jsonify({"error": str(e)})
 
 
-def retry_query_loop(server_url, payload, headers):
-    bounce_count += 1
-    print("POST request timed out. Number of Tries:", bounce_count)
-    print('Trying again...')
-    while bounce_count < 6:
+# Retry policy for posts that time out, can't connect or get a 5xx response.
+# Attempts are spaced with exponential backoff and full jitter, a random delay of
+# up to base_delay * 2^attempt seconds capped at max_delay, so hubs don't retry in
+# lockstep against a struggling server.
+class RetryPolicy:
+    def __init__(self, max_retries, base_delay, max_delay):
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def get_delay(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+def get_retry_policy():
+    return RetryPolicy(
+        config["ServerConf"].getint("retry_max_retries", 5),
+        config["ServerConf"].getfloat("retry_base_delay", 0.5),
+        config["ServerConf"].getfloat("retry_max_delay", 30),
+    )
+
+
+# Circuit breaker for one destination.
+# After failure_threshold failed posts in a row the circuit opens and the worker
+# parks its payloads instead of sending them. Once reset_timeout seconds have
+# passed a single probe is let through: if it is delivered the circuit closes,
+# otherwise it opens again with the timeout doubled, up to max_reset_timeout.
+class CircuitBreaker:
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half-open"
+
+    def __init__(self, server_url, failure_threshold, reset_timeout, max_reset_timeout):
+        self.server_url = server_url
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_reset_timeout = max_reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.current_timeout = reset_timeout
+        self.probe_at = 0
+        self.lock = threading.Lock()
+
+    # Whether a post may be sent now; the first caller after the reset timeout
+    # gets to send the probe
+    def allow_request(self):
+        with self.lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() >= self.probe_at:
+                self.state = self.HALF_OPEN
+                logger.info("Circuit half-open for %s - sending probe", self.server_url)
+                return True
+            return False
+
+    # Seconds until a post may be sent again
+    def get_wait_time(self):
+        with self.lock:
+            if self.state == self.OPEN:
+                return max(0, self.probe_at - time.monotonic())
+            if self.state == self.HALF_OPEN:
+                return 0.1  # Waiting on the probe
+            return 0
+
+    def is_open(self):
+        return self.state != self.CLOSED
+
+    def record_success(self):
+        with self.lock:
+            if self.state != self.CLOSED:
+                logger.info("Circuit closed for %s", self.server_url)
+            self.state = self.CLOSED
+            self.failures = 0
+            self.current_timeout = self.reset_timeout
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.state == self.HALF_OPEN:
+                self.current_timeout = min(self.current_timeout * 2, self.max_reset_timeout)
+            elif self.state == self.OPEN or self.failures < self.failure_threshold:
+                return
+            self.state = self.OPEN
+            self.probe_at = time.monotonic() + self.current_timeout
+            logger.warning("Circuit open for %s - parking payloads for %s seconds", self.server_url, self.current_timeout)
+
+def create_circuit_breaker(server_url):
+    return CircuitBreaker(
+        server_url,
+        config["ServerConf"].getint("breaker_failure_threshold", 5),
+        config["ServerConf"].getfloat("breaker_reset_timeout", 10),
+        config["ServerConf"].getfloat("breaker_max_reset_timeout", 300),
+    )
+
+# Collect up to batch_size payloads from the queue. Blocks for up to a second
+# for the first one (raising queue.Empty if nothing arrives), then waits at most
+# batch_wait milliseconds for the rest of the batch to fill up.
+def collect_batch(payload_queue, batch_size, batch_wait, batch=None):
+    if batch is None:
+        batch = []
+    batch.append(payload_queue.get(timeout=1))
+    payload_queue.task_done()
+
+    deadline = time.monotonic() + batch_wait / 1000
+    while len(batch) < batch_size:
+        remaining = deadline - time.monotonic()
         try:
-            post_response = requests.post(server_url, json=payload, headers=headers, timeout=5)
-            post_response.raise_for_status()
-            print("POST Status Code:", post_response.status_code)
-            print("POST Response Content:", post_response.content, "\n")
-            bounce_count = 0
+            if remaining > 0:
+                batch.append(payload_queue.get(timeout=remaining))
+            else:
+                batch.append(payload_queue.get_nowait())
+            payload_queue.task_done()
+        except queue.Empty:
             break
-        except requests.exceptions.Timeout:
-            bounce_count += 1
-            print("POST request timed out. Number of Tries:", bounce_count)
-            print('Trying again...')
-        except Exception as e:
-            print("Exception in main loop:", e)
-    else:
-        bounce_count = 0
-        print('POST request failed after 5 tries. Trying Next URL OR Next Packet...')
-        return
+    return batch
 
-if __name__ == '__main__':
 
-    # Need to run this from a shell script >>> os.system("pkill python")
+# Batches are posted as a JSON array to the sensors route plus this suffix
+batch_route_suffix = "/batch"
+# Servers that answered a batch post with one of these don't have a batch route
+batch_unsupported_codes = (404, 405, 501)
+# Returned by servers that can't read the batch's upload format or compression,
+# which are then dropped for plain JSON
+encoding_unsupported_codes = (415,)
 
-    # Create a thread for the Flask app
-    flask_thread = threading.Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': 5001})
-    flask_thread.daemon = True
-    flask_thread.start()
-    
-    #track the number of times a request bounces back
-    bounce_count = 0
+def get_batch_url(server_url):
+    return server_url.rstrip("/") + batch_route_suffix
 
-    # get the server urls and strip the whilespace
+# Post a single payload (or a list of them, to a batch route) to one server,
+# returning the status code or None if the request failed
+def post_payload(session, server_url, data, headers):
+    try:
+        # send the request with a timeout of 5 seconds
+        post_response = session.post(server_url, data=data, headers=headers, timeout=5)
+
+        # Check status code for response received (success code - 200)
+        logger.debug("POST Status Code: %s", post_response.status_code)
+        logger.debug("POST Response Content: %s", post_response.content)
+        return post_response.status_code
+    except requests.exceptions.RequestException as e:
+        logger.warning("POST request to %s failed: %s", server_url, e)
+        return None
+
+# A post counts as delivered once the server has processed it; timeouts, connection
+# errors (no status code), 429 Too Many Requests and 5xx responses leave the
+# payload to be retried
+def is_delivered(status_code):
+    return status_code is not None and status_code < 500 and status_code != 429
+
+
+# Optional durable spool for payloads, kept in SQLite in WAL mode.
+# Every payload gets a row per destination which is deleted once that destination
+# has accepted it, so whatever is left after a restart, power loss or long outage
+# is replayed in the order it was received. Rows are committed in groups every
+# commit_interval milliseconds instead of one fsync per reading, and the oldest
+# rows are dropped once there are more than max_entries.
+class PayloadSpool:
+    def __init__(self, path, max_entries, commit_interval):
+        self.connection = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=FULL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS payloads ("
+            "id INTEGER PRIMARY KEY AUTOINCREMENT, destination TEXT NOT NULL, body TEXT NOT NULL)"
+        )
+        self.connection.execute("CREATE INDEX IF NOT EXISTS payloads_destination ON payloads (destination, id)")
+        self.max_entries = max_entries
+        self.commit_interval = commit_interval / 1000
+        self.last_commit = time.monotonic()
+        # Shared by every worker thread; notified whenever payloads are added
+        self.lock = threading.Lock()
+        self.payloads_added = threading.Condition(self.lock)
+
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM payloads").fetchone()
+        if count:
+            logger.info("Recovered %d undelivered payloads from %s", count, path)
+
+    def begin(self):
+        if not self.connection.in_transaction:
+            self.connection.execute("BEGIN")
+
+    # Add a payload for each of the given destinations
+    def append(self, destinations, payload):
+        body = json.dumps(payload)
+        with self.lock:
+            self.begin()
+            self.connection.executemany(
+                "INSERT INTO payloads (destination, body) VALUES (?, ?)",
+                [(destination, body) for destination in destinations],
+            )
+            self.payloads_added.notify_all()
+
+    # Get up to limit (id, payload) entries for a destination after the given id,
+    # waiting up to timeout seconds for one to be added when there are none
+    def fetch(self, destination, after_id, limit, timeout=0):
+        query = "SELECT id, body FROM payloads WHERE destination = ? AND id > ? ORDER BY id LIMIT ?"
+        with self.lock:
+            rows = self.connection.execute(query, (destination, after_id, limit)).fetchall()
+            if not rows and timeout > 0:
+                self.payloads_added.wait(timeout)
+                rows = self.connection.execute(query, (destination, after_id, limit)).fetchall()
+        return [(entry_id, json.loads(body)) for entry_id, body in rows]
+
+    # Get the next batch of up to batch_size entries for a destination after the
+    # given id, the same way collect_batch does from a queue: wait up to a second
+    # for the first one and then at most batch_wait milliseconds for the rest
+    def fetch_batch(self, destination, after_id, batch_size, batch_wait):
+        entries = self.fetch(destination, after_id, batch_size, 1)
+        if not entries:
+            return entries
+
+        deadline = time.monotonic() + batch_wait / 1000
+        while len(entries) < batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            more = self.fetch(destination, entries[-1][0], batch_size - len(entries), remaining)
+            if not more:
+                break
+            entries += more
+        return entries
+
+    # Remove entries that have been delivered
+    def remove(self, entry_ids):
+        if not entry_ids:
+            return
+        with self.lock:
+            self.begin()
+            self.connection.executemany("DELETE FROM payloads WHERE id = ?", [(entry_id,) for entry_id in entry_ids])
+
+    # Commit everything since the last commit once commit_interval has passed
+    def commit_if_due(self):
+        with self.lock:
+            if not self.connection.in_transaction:
+                return
+            if time.monotonic() - self.last_commit < self.commit_interval:
+                return
+            self.trim()
+            self.connection.execute("COMMIT")
+            self.last_commit = time.monotonic()
+
+    # Drop the oldest entries beyond max_entries
+    def trim(self):
+        (count,) = self.connection.execute("SELECT COUNT(*) FROM payloads").fetchone()
+        excess = count - self.max_entries
+        if excess > 0:
+            self.connection.execute(
+                "DELETE FROM payloads WHERE id IN (SELECT id FROM payloads ORDER BY id LIMIT ?)", (excess,)
+            )
+            logger.warning("Spool full, dropped %d oldest payloads", excess)
+
+
+# Open the payload spool if spool_path is configured, otherwise payloads are only
+# kept in memory
+def open_payload_spool():
+    spool_path = config["ServerConf"].get("spool_path", "").strip()
+    if not spool_path:
+        return None
+    return PayloadSpool(
+        str(source_dir / spool_path),
+        config["ServerConf"].getint("spool_max_entries", 1000000),
+        config["ServerConf"].getint("spool_commit_interval", 1000),
+    )
+
+payload_spool = None
+
+
+# Forwards payloads to one destination server from its own queue, so a slow or
+# unreachable server only holds up its own deliveries and not everyone else's.
+# With a spool the queue is the destination's rows in the spool instead of memory.
+class DestinationWorker(threading.Thread):
+    def __init__(self, destination, parsed_config, spool=None):
+        super().__init__(daemon=True)
+        self.destination = destination
+        self.server_url = destination.server_url
+        self.headers = destination.headers
+        self.batch_size = parsed_config.batch_size
+        self.batch_wait = parsed_config.batch_wait
+        self.payload_queue = queue.Queue(maxsize=parsed_config.queue_size)
+        self.batch_supported = True
+        self.encoding_supported = True
+        self.running = True
+
+        self.retry_policy = get_retry_policy()
+        self.breaker = create_circuit_breaker(self.server_url)
+        self.metric_labels = (self.server_url,)
+        # Payloads that couldn't be delivered, sent again before anything new
+        self.parked = []
+        # The batch being collected or posted
+        self.batch = []
+
+        self.spool = spool
+        # Spool entries up to this id have been delivered
+        self.spool_cursor = 0
+        # Worker that takes over this one's undelivered payloads when it stops
+        self.successor = None
+
+    # Queue a payload for this destination, dropping the oldest one when the
+    # queue is full so an unreachable server can't use up all the memory
+    def enqueue(self, payload):
+        while True:
+            try:
+                self.payload_queue.put_nowait(payload)
+                return
+            except queue.Full:
+                try:
+                    self.payload_queue.get_nowait()
+                    logger.warning("Queue full for %s - dropping oldest payload", self.server_url)
+                except queue.Empty:
+                    pass
+
+    # Stop after the batch in flight. Payloads still parked or queued then go to
+    # the successor, if there is one, instead of being dropped.
+    def stop(self, successor=None):
+        self.successor = successor
+        self.running = False
+
+    def run(self):
+        self.forward()
+        if self.successor is not None:
+            hand_off_payloads(self.held_payloads(), self.payload_queue, self.successor)
+            self.parked = []
+
+    # Payloads taken off the queue that haven't been delivered yet
+    def held_payloads(self):
+        return self.parked + self.batch
+
+    def forward(self):
+        while self.running:
+            try:
+                # Leave payloads parked while the circuit is open
+                wait_time = self.breaker.get_wait_time()
+                if wait_time > 0:
+                    time.sleep(min(wait_time, 1))
+                    continue
+
+                if self.spool is None:
+                    if self.parked:
+                        self.batch, self.parked = self.parked, []
+                    else:
+                        self.batch = []
+                        collect_batch(self.payload_queue, self.batch_size, self.batch_wait, self.batch)
+                    delivered = self.post_batch(self.batch)
+                    payloads_delivered.inc(sum(delivered), labels=self.metric_labels)
+                    self.parked = [payload for payload, ok in zip(self.batch, delivered) if not ok]
+                    self.batch = []
+                else:
+                    entries = self.spool.fetch_batch(self.server_url, self.spool_cursor, self.batch_size, self.batch_wait)
+                    if not entries:
+                        continue
+                    delivered = self.post_batch([payload for _, payload in entries])
+                    payloads_delivered.inc(sum(delivered), labels=self.metric_labels)
+                    self.spool.remove([entry[0] for entry, ok in zip(entries, delivered) if ok])
+                    self.advance_spool_cursor(entries, delivered)
+            except queue.Empty:
+                pass  # No new payloads to process
+            except Exception as e:
+                logger.error("Exception forwarding to %s: %s", self.server_url, e)
+
+    # Move the spool cursor past a posted batch of (id, payload) entries, but
+    # never past the first one that wasn't delivered, so the next batch starts
+    # there and the spool is replayed in order
+    def advance_spool_cursor(self, entries, delivered):
+        for (entry_id, _), ok in zip(entries, delivered):
+            if not ok:
+                self.spool_cursor = entry_id - 1
+                return
+        self.spool_cursor = entries[-1][0]
+
+    # Post a batch of payloads, as a single request when the server has a
+    # batch route and one request per payload when it doesn't.
+    # Returns whether each payload was delivered.
+    def post_batch(self, batch):
+        if len(batch) > 1 and self.batch_supported:
+            status_code = self.send(self.destination.batch_url, batch)
+            if status_code in encoding_unsupported_codes and self.is_encoded():
+                logger.info("Server does not accept %s uploads, falling back to JSON: %s", self.encoding_name(), self.server_url)
+                self.encoding_supported = False
+                status_code = self.send(self.destination.batch_url, batch)
+            if status_code not in batch_unsupported_codes:
+                return [is_delivered(status_code)] * len(batch)
+            logger.info("Server does not accept batches, falling back to single posts: %s", self.server_url)
+            self.batch_supported = False
+
+        return [is_delivered(self.send(self.server_url, payload)) for payload in batch]
+
+    def is_encoded(self):
+        return self.encoding_supported and (self.destination.upload_format, self.destination.compression) != ("json", "none")
+
+    def encoding_name(self):
+        return "{} ({})".format(self.destination.upload_format, self.destination.compression)
+
+    # Encode a body for posting: batches in the destination's upload format and
+    # compression unless the server turned them down, single payloads as JSON
+    def encode(self, body):
+        if isinstance(body, list) and self.is_encoded():
+            data, headers = encode_upload(body, self.destination.upload_format, self.destination.compression)
+        else:
+            data, headers = encode_upload(body)
+        return data, dict(self.headers, **headers)
+
+    # Post with retries, backing off between attempts and giving up early once
+    # the circuit opens. Returns the last status code, or None if nothing got through.
+    def send(self, server_url, body):
+        data, headers = self.encode(body)
+        attempt = 0
+        while True:
+            if not self.breaker.allow_request():
+                return None
+            start_time = time.monotonic()
+            status_code = post_payload(self.destination.session, server_url, data, headers)
+            post_duration.observe(time.monotonic() - start_time, self.metric_labels)
+            if is_delivered(status_code):
+                self.breaker.record_success()
+                posts_sent.inc(labels=self.metric_labels + ("delivered",))
+                return status_code
+
+            self.breaker.record_failure()
+            posts_sent.inc(labels=self.metric_labels + ("failed",))
+            if attempt >= self.retry_policy.max_retries or self.breaker.is_open():
+                return status_code
+
+            delay = self.retry_policy.get_delay(attempt)
+            attempt += 1
+            post_retries.inc(labels=self.metric_labels)
+            logger.warning("POST to %s failed, retry %d in %.2f seconds", server_url, attempt, delay)
+            time.sleep(delay)
+
+
+# Move a stopped worker's undelivered payloads, held ones first, to the worker
+# that replaced it. With a spool both workers read the same rows, so there is
+# nothing to move.
+def hand_off_payloads(held, payload_queue, successor):
+    payloads = list(held)
+    while True:
+        try:
+            payloads.append(payload_queue.get_nowait())
+        except (queue.Empty, asyncio.QueueEmpty):
+            break
+    for payload in payloads:
+        successor.enqueue(payload)
+    if payloads:
+        logger.info("Handed %d undelivered payloads over to the new worker for %s", len(payloads), successor.server_url)
+
+# The new worker for the same server as a stopped one, if there is one
+def find_successor(worker, workers):
+    return next((candidate for candidate in workers if candidate.server_url == worker.server_url), None)
+
+# Work out the workers for a new configuration. Workers for destinations that
+# haven't changed are kept, along with the payloads queued for them, as long as
+# the batch and queue settings are the same. Returns the workers to use, creating
+# any missing ones with create_worker, and the old workers that should be stopped.
+def reconcile_workers(workers, old_config, new_config, create_worker):
+    def destination_key(destination):
+        return (destination.server_url, destination.api_key, destination.upload_format, destination.compression)
+
+    def worker_settings(parsed_config):
+        return (parsed_config.batch_size, parsed_config.batch_wait, parsed_config.queue_size, parsed_config.pool_size)
+
+    reusable = {}
+    if old_config is not None and worker_settings(old_config) == worker_settings(new_config):
+        reusable = {destination_key(worker.destination): worker for worker in workers}
+
+    new_workers = []
+    for destination in new_config.destinations:
+        worker = reusable.pop(destination_key(destination), None)
+        new_workers.append(worker if worker is not None else create_worker(destination))
+
+    stopped_workers = [worker for worker in workers if worker not in new_workers]
+    return new_workers, stopped_workers
+
+
+# One worker per configured destination, updated whenever a new configuration
+# is swapped in
+destination_workers = []
+destination_workers_conf = None
+
+def create_destination_worker(destination):
+    worker = DestinationWorker(destination, get_parsed_config(), payload_spool)
+    worker.start()
+    return worker
+
+def get_destination_workers():
+    global destination_workers, destination_workers_conf
+
+    current_config = get_parsed_config()
+    if current_config is destination_workers_conf:
+        return destination_workers
+
+    workers, stopped_workers = reconcile_workers(
+        destination_workers, destination_workers_conf, current_config, create_destination_worker
+    )
+    for worker in stopped_workers:
+        worker.stop(find_successor(worker, workers))
+
+    destination_workers = workers
+    destination_workers_conf = current_config
+    return workers
+
+# Gauges computed from the running pipeline each time /metrics is scraped
+CIRCUIT_STATE_VALUES = {CircuitBreaker.CLOSED: 0, CircuitBreaker.HALF_OPEN: 1, CircuitBreaker.OPEN: 2}
 
-    # Main loop to process JSON payloads and make POST requests
+def get_destination_queue_depths():
+    return {
+        (worker.server_url,): worker.payload_queue.qsize() + len(worker.held_payloads())
+        for worker in destination_workers
+    }
+
+def get_circuit_states():
+    return {(worker.server_url,): CIRCUIT_STATE_VALUES[worker.breaker.state] for worker in destination_workers}
+
+def get_spool_entries():
+    if payload_spool is None:
+        return {}
+    with payload_spool.lock:
+        (count,) = payload_spool.connection.execute("SELECT COUNT(*) FROM payloads").fetchone()
+    return {(): count}
+
+# Serial throughput since the previous scrape
+serial_rate_sample = [time.monotonic(), 0]
+
+def get_serial_byte_rate():
+    now = time.monotonic()
+    total = serial_bytes_read.get()
+    last_time, last_total = serial_rate_sample
+    serial_rate_sample[:] = [now, total]
+    return {(): round((total - last_total) / max(now - last_time, 1e-6), 1)}
+
+Gauge("xbee_payload_queue_depth", "Payloads decoded but not yet handed to the destinations",
+      callback=lambda: {(): json_payload_queue.qsize()})
+Gauge("xbee_destination_queue_depth", "Payloads waiting in memory for each destination", ("destination",),
+      callback=get_destination_queue_depths)
+Gauge("xbee_circuit_state", "Circuit breaker state per destination (0 closed, 1 half-open, 2 open)", ("destination",),
+      callback=get_circuit_states)
+Gauge("xbee_spool_entries", "Undelivered payloads in the spool", callback=get_spool_entries)
+Gauge("xbee_serial_bytes_per_second", "Serial bytes read per second since the last scrape", callback=get_serial_byte_rate)
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(render_metrics(), mimetype="text/plain; version=0.0.4")
+
+
+# Optional asyncio forwarding engine (engine = asyncio).
+# Serial reading, frame decoding, fan-out and delivery run as tasks connected by
+# bounded queues in one event loop, with aiohttp sessions instead of a thread per
+# destination. It uses the same configuration and payloads as the threaded engine.
+
+# Collect up to batch_size payloads from an asyncio queue, waiting for the first
+# one and then at most batch_wait milliseconds for the rest. Payloads are added
+# to batch as they arrive, so a cancelled collection leaves them with the caller.
+async def async_collect_batch(payload_queue, batch_size, batch_wait, batch=None):
+    loop = asyncio.get_running_loop()
+    if batch is None:
+        batch = []
+    batch.append(await payload_queue.get())
+
+    deadline = loop.time() + batch_wait / 1000
+    while len(batch) < batch_size:
+        if not payload_queue.empty():
+            batch.append(payload_queue.get_nowait())
+            continue
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            break
+        try:
+            batch.append(await asyncio.wait_for(payload_queue.get(), remaining))
+        except asyncio.TimeoutError:
+            break
+    return batch
+
+
+# The asyncio engine's counterpart to DestinationWorker. Without a spool, up to
+# http_pool_size batches are in flight at once; with one, batches go out in order.
+class AsyncDestinationWorker:
+    def __init__(self, destination, parsed_config, spool=None):
+        self.destination = destination
+        self.server_url = destination.server_url
+        self.headers = destination.headers
+        self.batch_size = parsed_config.batch_size
+        self.batch_wait = parsed_config.batch_wait
+        self.payload_queue = asyncio.Queue(maxsize=parsed_config.queue_size)
+        self.pool_size = parsed_config.pool_size
+        self.batch_supported = True
+        self.encoding_supported = True
+        self.session = None
+        self.tasks = []
+
+        self.retry_policy = get_retry_policy()
+        self.breaker = create_circuit_breaker(self.server_url)
+        self.metric_labels = (self.server_url,)
+
+        self.spool = spool
+        self.spool_cursor = 0
+        # Each sender's batch, see run()
+        self.sender_batches = []
+
+    def start(self):
+        self.session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=self.pool_size),
+            timeout=aiohttp.ClientTimeout(total=5),
+        )
+        senders = 1 if self.spool is not None else self.pool_size
+        self.tasks = [asyncio.create_task(self.run()) for _ in range(senders)]
+
+    # Cancel the senders. Payloads they held or that are still queued then go to
+    # the successor, if there is one, instead of being dropped.
+    async def stop(self, successor=None):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+        await self.session.close()
+        if successor is not None:
+            hand_off_payloads(self.held_payloads(), self.payload_queue, successor)
+            self.sender_batches = []
+
+    # Payloads taken off the queue that haven't been delivered yet
+    def held_payloads(self):
+        return [payload for batch in self.sender_batches for payload in batch]
+
+    # Queue a payload for this destination, dropping the oldest one when the queue is full
+    def enqueue(self, payload):
+        while True:
+            try:
+                self.payload_queue.put_nowait(payload)
+                return
+            except asyncio.QueueFull:
+                self.payload_queue.get_nowait()
+                logger.warning("Queue full for %s - dropping oldest payload", self.server_url)
+
+    async def run(self):
+        loop = asyncio.get_running_loop()
+        # The payloads this sender is collecting or posting. Any it couldn't
+        # deliver are left in it and sent again before anything new.
+        batch = []
+        self.sender_batches.append(batch)
+        while True:
+            try:
+                # Leave payloads parked while the circuit is open
+                wait_time = self.breaker.get_wait_time()
+                if wait_time > 0:
+                    await asyncio.sleep(min(wait_time, 1))
+                    continue
+
+                if self.spool is None:
+                    if not batch:
+                        await async_collect_batch(self.payload_queue, self.batch_size, self.batch_wait, batch)
+                    delivered = await self.post_batch(list(batch))
+                    payloads_delivered.inc(sum(delivered), labels=self.metric_labels)
+                    batch[:] = [payload for payload, ok in zip(batch, delivered) if not ok]
+                    continue
+
+                entries = await loop.run_in_executor(
+                    None, self.spool.fetch_batch, self.server_url, self.spool_cursor, self.batch_size, self.batch_wait
+                )
+                if not entries:
+                    continue
+
+                delivered = await self.post_batch([payload for _, payload in entries])
+                payloads_delivered.inc(sum(delivered), labels=self.metric_labels)
+                await loop.run_in_executor(
+                    None, self.spool.remove, [entry[0] for entry, ok in zip(entries, delivered) if ok]
+                )
+                self.advance_spool_cursor(entries, delivered)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error("Exception forwarding to %s: %s", self.server_url, e)
+
+    # Post a single payload (or a list of them, to a batch route), returning the
+    # status code or None if the request failed
+    async def post_payload(self, server_url, data, headers):
+        try:
+            async with self.session.post(server_url, data=data, headers=headers) as post_response:
+                content = await post_response.read()
+                logger.debug("POST Status Code: %s", post_response.status)
+                logger.debug("POST Response Content: %s", content)
+                return post_response.status
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            logger.warning("POST request to %s failed: %s", server_url, e)
+            return None
+
+    # Batches are encoded, and the spool cursor moved on, the same way as by DestinationWorker
+    is_encoded = DestinationWorker.is_encoded
+    encoding_name = DestinationWorker.encoding_name
+    encode = DestinationWorker.encode
+    advance_spool_cursor = DestinationWorker.advance_spool_cursor
+
+    # Same as DestinationWorker.post_batch
+    async def post_batch(self, batch):
+        if len(batch) > 1 and self.batch_supported:
+            status_code = await self.send(self.destination.batch_url, batch)
+            if status_code in encoding_unsupported_codes and self.is_encoded():
+                logger.info("Server does not accept %s uploads, falling back to JSON: %s", self.encoding_name(), self.server_url)
+                self.encoding_supported = False
+                status_code = await self.send(self.destination.batch_url, batch)
+            if status_code not in batch_unsupported_codes:
+                return [is_delivered(status_code)] * len(batch)
+            logger.info("Server does not accept batches, falling back to single posts: %s", self.server_url)
+            self.batch_supported = False
+
+        return [is_delivered(await self.send(self.server_url, payload)) for payload in batch]
+
+    # Same as DestinationWorker.send
+    async def send(self, server_url, body):
+        data, headers = self.encode(body)
+        attempt = 0
+        while True:
+            if not self.breaker.allow_request():
+                return None
+            start_time = time.monotonic()
+            status_code = await self.post_payload(server_url, data, headers)
+            post_duration.observe(time.monotonic() - start_time, self.metric_labels)
+            if is_delivered(status_code):
+                self.breaker.record_success()
+                posts_sent.inc(labels=self.metric_labels + ("delivered",))
+                return status_code
+
+            self.breaker.record_failure()
+            posts_sent.inc(labels=self.metric_labels + ("failed",))
+            if attempt >= self.retry_policy.max_retries or self.breaker.is_open():
+                return status_code
+
+            delay = self.retry_policy.get_delay(attempt)
+            attempt += 1
+            post_retries.inc(labels=self.metric_labels)
+            logger.warning("POST to %s failed, retry %d in %.2f seconds", server_url, attempt, delay)
+            await asyncio.sleep(delay)
+
+
+# Read the serial port in a dedicated thread and pass the raw chunks on
+async def async_serial_reader(chunk_queue, source):
+    port, capture = source.port, source.capture
+    loop = asyncio.get_running_loop()
+    read_chunk_size = config["ServerConf"].getint("read_chunk_size", 4096)
+    port.timeout = config["ServerConf"].getfloat("read_timeout", 0.05)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+        while True:
+            try:
+                new_data = await loop.run_in_executor(executor, port.read, get_read_size(port, read_chunk_size))
+                if new_data:
+                    received_ns = receive_time_ns()
+                    serial_bytes_read.inc(len(new_data))
+                    if capture is not None:
+                        capture.write(new_data, received_ns)
+                    await chunk_queue.put((new_data, received_ns))
+            except Exception as e:
+                logger.error("Exception in serial_reader: %s", e)
+                await asyncio.sleep(1)
+
+# Decode frames from the raw chunks and pass the resulting payloads on
+async def async_frame_decoder(chunk_queue, payload_queue, radio):
+    decoder = create_frame_decoder(config["ServerConf"].getint("api_mode", 1) == 2, radio)
     while True:
+        new_data, received_ns = await chunk_queue.get()
         try:
-            payload = json_payload_queue.get(timeout=1)
+            decoder.feed(new_data, received_ns)
+        except Exception as e:
+            logger.error("Exception in frame decoder: %s", e)
+
+        # The frame handlers queue their payloads with add_json_payload
+        while True:
+            try:
+                payload = json_payload_queue.get_nowait()
+            except queue.Empty:
+                break
             json_payload_queue.task_done()
+            await payload_queue.put(payload)
+
+# Hand each payload to every destination's worker, updating the workers when
+# the configuration changes
+async def async_dispatcher(payload_queue, spool):
+    loop = asyncio.get_running_loop()
+    workers = []
+    workers_conf = None
+
+    def create_worker(destination):
+        worker = AsyncDestinationWorker(destination, get_parsed_config(), spool)
+        worker.start()
+        return worker
+
+    async def update_workers():
+        nonlocal workers, workers_conf
+        global destination_workers
+        current_config = get_parsed_config()
+        if current_config is not workers_conf:
+            workers, stopped_workers = reconcile_workers(workers, workers_conf, current_config, create_worker)
+            for worker in stopped_workers:
+                await worker.stop(find_successor(worker, workers))
+            workers_conf = current_config
+            # Shared with /metrics
+            destination_workers = workers
+
+    # Start the workers before anything arrives, so payloads recovered from the
+    # spool are replayed straight away
+    await update_workers()
 
-            server_urls = get_server_urls(config["ServerConf"]["server_url"], main_route)
-            api_keys = get_api_keys(config["ServerConf"]["api_key"])
+    while True:
+        payload = await payload_queue.get()
+        try:
+            await update_workers()
 
-            for i in range(len(server_urls)):
-                current_server_url = server_urls[i]
+            if spool is not None:
+                await loop.run_in_executor(None, spool.append, [worker.server_url for worker in workers], payload)
+            else:
+                for worker in workers:
+                    worker.enqueue(payload)
+        except Exception as e:
+            logger.error("Exception in main loop: %s", e)
 
-                # if only one api key is given, use it
-                current_api_key = api_keys[i] if len(api_keys) > 1 else api_keys[0]
-                headers = {
-                    "Authorization": f"{current_api_key}",
-                    "Content-Type": "application/json",
-                    "Content-Encoding": "utf-8"
-                }
+# Close edge filter windows of nodes that have gone quiet
+async def async_edge_filter_flusher(payload_queue):
+    while True:
+        await asyncio.sleep(EdgeFilter.flush_interval / 1000)
+        for payload in edge_filter.flush():
+            payloads_queued.inc()
+            await payload_queue.put(payload)
+
+# Group commit the spool on the same schedule as the threaded engine
+async def async_spool_committer(spool):
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(spool.commit_interval or 1)
+        await loop.run_in_executor(None, spool.commit_if_due)
+
+async def run_async_engine(spool, sources):
+    queue_size = config["ServerConf"].getint("async_queue_size", 1000)
+    payload_queue = asyncio.Queue(maxsize=queue_size)
+
+    # Each radio gets its own reader and decoder feeding the shared payload queue
+    tasks = [async_dispatcher(payload_queue, spool), async_edge_filter_flusher(payload_queue)]
+    for source in sources:
+        chunk_queue = asyncio.Queue(maxsize=queue_size)
+        tasks.append(async_serial_reader(chunk_queue, source))
+        tasks.append(async_frame_decoder(chunk_queue, payload_queue, source.radio))
+    if spool is not None:
+        tasks.append(async_spool_committer(spool))
+    await asyncio.gather(*tasks)
+
+
+# Threaded engine: a thread per radio reads its serial port and the main loop
+# hands each payload to a DestinationWorker thread per destination
+def run_threaded_engine(spool, sources):
+    # Create a separate thread for reading each serial port
+    for source in sources:
+        serial_thread = threading.Thread(target=serial_reader, args=(source,))
+        serial_thread.daemon = True
+        serial_thread.start()
+
+    # Main loop to hand each JSON payload to every destination's worker. The
+    # workers are brought up to date first, even with nothing to send, so payloads
+    # recovered from the spool are replayed as soon as the engine starts.
+    while True:
+        try:
+            workers = get_destination_workers()
+            payload = json_payload_queue.get(timeout=1)
+            json_payload_queue.task_done()
 
-                try: 
-                    # send the request with a timeout of 5 seconds
-                    post_response = requests.post(current_server_url, json=payload, headers=headers, timeout=5)
-                    
-                    bounce_count = 0 #reset the bounce counter
+            if spool is not None:
+                spool.append([worker.server_url for worker in workers], payload)
+            else:
+                for worker in workers:
+                    worker.enqueue(payload)
 
-                    # Check status code for response received (success code - 200)
-                    print("POST Status Code:", post_response.status_code)
-                    print("POST Response Content:", post_response.content, "\n")
-                except requests.exceptions.Timeout:
-                    retry_query_loop(current_server_url, payload, headers)
-                    
         except queue.Empty:
             pass  # No new payloads to process
 
         except Exception as e:
-            print("Exception in main loop:", e)
\ No newline at end of file
+            logger.error("Exception in main loop: %s", e)
+
+        if spool is not None:
+            spool.commit_if_due()
+
+        # Close edge filter windows of nodes that have gone quiet
+        queue_filtered_payloads(edge_filter.flush())
+
+
+if __name__ == '__main__':
+
+    # Need to run this from a shell script >>> os.system("pkill python")
+
+    # Create a thread for the Flask app
+    flask_thread = threading.Thread(target=app.run, kwargs={'host': '0.0.0.0', 'port': 5001})
+    flask_thread.daemon = True
+    flask_thread.start()
+
+    # Pick up changes to configfile.ini while running
+    config_thread = threading.Thread(target=config_watcher)
+    config_thread.daemon = True
+    config_thread.start()
+
+    # Keep undelivered payloads on disk if a spool is configured
+    payload_spool = open_payload_spool()
+
+    # Open every coordinator radio, recording its raw serial stream if a
+    # capture path is configured
+    try:
+        serial_sources = open_serial_sources()
+    except Exception as e:
+        raise SystemExit("Could not open serial port: {}".format(e))
+
+    if config["ServerConf"].get("engine", "threads") == "asyncio":
+        if aiohttp is None:
+            raise SystemExit("The asyncio engine needs aiohttp, install it with: pip install aiohttp")
+        asyncio.run(run_async_engine(payload_spool, serial_sources))
+    else:
+        run_threaded_engine(payload_spool, serial_sources)
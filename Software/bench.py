@@ -0,0 +1,351 @@
+"""End to end ingest benchmark for the sensor hub.
+
+Generates a stream of 0x90 and 0x92 frames from a number of simulated nodes,
+feeds it through a fake serial port into the real decoder and forwarder in
+app.py, and posts to a stand-in server running in a separate process. Reports
+frames per second, end to end latency from the serial read to the server, and
+CPU time per frame.
+
+    python bench.py --nodes 50 --rate 20 --duration 10
+    python bench.py --rate 0 --frames 100000 --escaped --noise 0.01
+"""
+import argparse
+import collections
+import json
+import logging
+import multiprocessing
+import queue
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+FRAME_DELIMITER = 0x7E
+ESCAPE = 0x7D
+ESCAPED_BYTES = (0x7E, 0x7D, 0x11, 0x13)
+
+# Analog inputs reported by simulated 0x92 nodes, matching app.ANALOG_CHANNELS
+SAMPLE_CHANNELS = ("AD0", "AD1", "AD2", "AD3")
+
+
+def escape_api_data(data):
+    escaped = bytearray()
+    for byte in data:
+        if byte in ESCAPED_BYTES:
+            escaped.append(ESCAPE)
+            escaped.append(byte ^ 0x20)
+        else:
+            escaped.append(byte)
+    return bytes(escaped)
+
+# Wrap frame data (frame type onwards) with the delimiter, length and checksum
+def build_frame(frame_data, escaped=False):
+    body = len(frame_data).to_bytes(2, "big") + frame_data + bytes([0xFF - (sum(frame_data) & 0xFF)])
+    if escaped:
+        body = escape_api_data(body)
+    return bytes([FRAME_DELIMITER]) + body
+
+# 0x90 receive packet carrying an ASCII reading, as sent by the sensor code
+def build_receive_packet(address, reading):
+    return bytes([0x90]) + address + b"\xff\xfe" + b"\x01" + str(reading).encode("ascii")
+
+# 0x92 I/O sample packet with one sample of the first channel_count analog inputs
+def build_io_sample_packet(address, raw_values):
+    analog_mask = (1 << len(raw_values)) - 1
+    samples = b"".join(value.to_bytes(2, "big") for value in raw_values)
+    return bytes([0x92]) + address + b"\xff\xfe" + b"\x01" + b"\x01" + b"\x00\x00" + bytes([analog_mask]) + samples
+
+# Convert a raw ADC reading the way app.parse_io_samples() does
+def io_sample_value(raw):
+    return (raw / 1023) * 2.5
+
+
+# Produces the frames of every simulated node in turn. Each frame comes with
+# the keys of the payloads the forwarder should post for it, so arrivals at the
+# server can be matched back to the frame. Corrupted frames have no keys.
+class FrameGenerator:
+    def __init__(self, nodes, io_ratio, channels, corrupt_ratio, noise_ratio, escaped, seed):
+        self.random = random.Random(seed)
+        self.addresses = [(0x0013A20000000000 + node).to_bytes(8, "big") for node in range(nodes)]
+        self.io_ratio = io_ratio
+        self.channels = SAMPLE_CHANNELS[:channels]
+        self.corrupt_ratio = corrupt_ratio
+        self.noise_ratio = noise_ratio
+        self.escaped = escaped
+        self.sequence = 0
+        self.corrupted = 0
+
+    def noise(self):
+        # Never emit a delimiter or escape byte, so noise can only cost a resync
+        # and not swallow the frame after it
+        return bytes(self.random.randint(0x00, 0x7C) for _ in range(self.random.randint(1, 16)))
+
+    def next_frame(self):
+        address = self.addresses[self.sequence % len(self.addresses)]
+        address_hex = address.hex().upper()
+        self.sequence += 1
+
+        if self.random.random() < self.io_ratio:
+            raw_values = [self.random.randint(0, 1023) for _ in self.channels]
+            frame_data = build_io_sample_packet(address, raw_values)
+            keys = [
+                (address_hex, None if channel == "AD0" else channel, io_sample_value(raw))
+                for channel, raw in zip(self.channels, raw_values)
+            ]
+        else:
+            reading = float(self.sequence)
+            frame_data = build_receive_packet(address, reading)
+            keys = [(address_hex, None, reading)]
+
+        frame = bytearray(build_frame(frame_data, self.escaped))
+        if self.random.random() < self.corrupt_ratio:
+            # Flip bits in the checksum so the frame is still framed correctly but rejected
+            frame[-1] ^= 0x5A
+            if self.escaped and frame[-1] in ESCAPED_BYTES:
+                frame[-1] ^= 0x01
+            self.corrupted += 1
+            keys = []
+
+        if self.random.random() < self.noise_ratio:
+            frame[0:0] = self.noise()
+        return bytes(frame), keys
+
+
+# Stands in for the serial port. Frames are released at the configured rate
+# (or as fast as they are read with a rate of 0) and a read returns up to size
+# bytes, splitting frames across reads like a real port. Every frame's payload
+# keys are recorded with the time the read holding its last byte returned.
+class FakeSerialPort:
+    def __init__(self, generator, frame_rate, total_frames):
+        self.generator = generator
+        self.frame_rate = frame_rate
+        self.total_frames = total_frames
+        self.timeout = 0.05
+        self.pending = bytearray()
+        self.frame_ends = collections.deque()
+        self.consumed = 0
+        self.produced = 0
+        self.frames_generated = 0
+        self.start_time = None
+        self.sent = collections.defaultdict(collections.deque)
+        self.sent_lock = threading.Lock()
+        self.finished = threading.Event()
+
+    def generate(self, count):
+        for _ in range(count):
+            frame, keys = self.generator.next_frame()
+            self.pending += frame
+            self.produced += len(frame)
+            self.frame_ends.append((self.produced, keys))
+            self.frames_generated += 1
+
+    def frames_due(self, size):
+        remaining = self.total_frames - self.frames_generated
+        if self.frame_rate <= 0:
+            # Keep about one read's worth of frames buffered
+            return min(remaining, max(0, size - len(self.pending)) // 16 + 1)
+        elapsed = time.monotonic() - self.start_time
+        return min(remaining, int(elapsed * self.frame_rate) - self.frames_generated)
+
+    def read(self, size=1):
+        if self.start_time is None:
+            self.start_time = time.monotonic()
+
+        due = self.frames_due(size)
+        if due > 0:
+            self.generate(due)
+
+        if not self.pending:
+            if self.frames_generated >= self.total_frames:
+                self.finished.set()
+            time.sleep(self.timeout if self.frame_rate <= 0 else min(self.timeout, 1 / self.frame_rate))
+            return b""
+
+        data = bytes(self.pending[:size])
+        del self.pending[:size]
+        self.consumed += len(data)
+
+        now = time.monotonic()
+        with self.sent_lock:
+            while self.frame_ends and self.frame_ends[0][0] <= self.consumed:
+                for key in self.frame_ends.popleft()[1]:
+                    self.sent[key].append(now)
+        return data
+
+    def close(self):
+        pass
+
+
+# Stand-in destination server. Runs in its own process so its CPU time is not
+# counted against the hub, and sends (arrival time, payloads) for every request
+# back over the results queue.
+class StandInHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # The headers and body go out in separate writes, which would otherwise sit
+    # behind the client's delayed ACK on every keep-alive request
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        arrival = time.monotonic()
+        payloads = json.loads(body)
+        if isinstance(payloads, dict):
+            payloads = [payloads]
+        self.server.results.put((arrival, payloads))
+
+        response = b'{"status": "ok"}'
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(response)))
+        self.end_headers()
+        self.wfile.write(response)
+
+    def log_message(self, format, *args):
+        pass
+
+def run_stand_in_server(port_queue, results):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StandInHandler)
+    server.daemon_threads = True
+    server.results = results
+    port_queue.put(server.server_address[1])
+    server.serve_forever()
+
+
+def percentile(values, fraction):
+    if not values:
+        return float("nan")
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+def run_benchmark(args):
+    # Start the stand-in server first so it is ready when the forwarder is
+    port_queue = multiprocessing.Queue()
+    results = multiprocessing.Queue()
+    server_process = multiprocessing.Process(target=run_stand_in_server, args=(port_queue, results), daemon=True)
+    server_process.start()
+    server_port = port_queue.get(timeout=10)
+
+    frame_rate = args.nodes * args.rate
+    total_frames = args.frames or int(frame_rate * args.duration)
+    generator = FrameGenerator(
+        args.nodes, args.io_ratio, args.channels, args.corrupt, args.noise, args.escaped, args.seed
+    )
+    fake_port = FakeSerialPort(generator, frame_rate, total_frames)
+
+    import app
+
+    app.logger.setLevel(args.log_level)
+    settings = app.config["ServerConf"]
+    settings["server_url"] = "http://127.0.0.1:{}".format(server_port)
+    settings["api_key"] = "bench"
+    settings["api_mode"] = "2" if args.escaped else "1"
+    settings["read_chunk_size"] = str(args.chunk_size)
+    settings["batch_size"] = str(args.batch_size)
+    settings["batch_wait"] = str(args.batch_wait)
+    settings["http_pool_size"] = str(args.pool_size)
+    settings["engine"] = args.engine
+    # The stand-in server reads plain JSON and every reading is expected to
+    # arrive, so upload encodings and edge filters from configfile.ini are off
+    settings["upload_format"] = "json"
+    settings["upload_compression"] = "none"
+    for option in ("filter_deadband", "filter_min_interval", "filter_max_interval", "filter_window"):
+        settings[option] = "0"
+    for section in app.config.sections():
+        if section.startswith(app.node_section_prefix):
+            app.config.remove_section(section)
+    app.reload_parsed_config()
+
+    sources = [app.SerialSource(None, fake_port, None)]
+    cpu_start = time.process_time()
+    wall_start = time.monotonic()
+    if args.engine == "asyncio":
+        engine = threading.Thread(target=app.asyncio.run, args=(app.run_async_engine(None, sources),), daemon=True)
+    else:
+        engine = threading.Thread(target=app.run_threaded_engine, args=(None, sources), daemon=True)
+    engine.start()
+
+    # Match arrivals to the frames they came from until everything expected has
+    # arrived, or nothing more turns up for drain_timeout seconds after the
+    # generator is done
+    latencies = []
+    unmatched = 0
+    received = 0
+    last_arrival = wall_start
+    while True:
+        try:
+            arrival, payloads = results.get(timeout=0.1)
+        except queue.Empty:
+            if fake_port.finished.is_set() and time.monotonic() - last_arrival > args.drain_timeout:
+                break
+            continue
+
+        last_arrival = time.monotonic()
+        with fake_port.sent_lock:
+            for payload in payloads:
+                received += 1
+                key = (payload["source_address_64"], payload.get("channel"), payload["data"])
+                sent_times = fake_port.sent.get(key)
+                if sent_times:
+                    latencies.append(arrival - sent_times.popleft())
+                else:
+                    unmatched += 1
+            pending = sum(len(times) for times in fake_port.sent.values())
+        if fake_port.finished.is_set() and pending == 0:
+            break
+
+    wall_time = last_arrival - wall_start
+    cpu_time = time.process_time() - cpu_start
+    server_process.terminate()
+
+    frames_decoded = sum(app.frames_decoded.collect().values())
+    latencies.sort()
+    report = {
+        "frames_generated": fake_port.frames_generated,
+        "frames_corrupted": generator.corrupted,
+        "frames_decoded": frames_decoded,
+        "checksum_failures": app.checksum_failures.get(),
+        "payloads_received": received,
+        "payloads_lost": sum(len(times) for times in fake_port.sent.values()),
+        "payloads_unmatched": unmatched,
+        "wall_seconds": round(wall_time, 3),
+        "frames_per_second": round(frames_decoded / wall_time, 1) if wall_time > 0 else 0,
+        "latency_p50_ms": round(percentile(latencies, 0.50) * 1000, 3),
+        "latency_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        "cpu_us_per_frame": round(cpu_time / frames_decoded * 1e6, 1) if frames_decoded else 0,
+    }
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the serial to HTTP ingest path with synthetic XBee frames")
+    parser.add_argument("--nodes", type=int, default=20, help="simulated sensor nodes")
+    parser.add_argument("--rate", type=float, default=10, help="frames per second per node, 0 to send as fast as possible")
+    parser.add_argument("--duration", type=float, default=10, help="seconds of frames to generate")
+    parser.add_argument("--frames", type=int, default=0, help="total frames to generate, overrides --duration")
+    parser.add_argument("--io-ratio", type=float, default=0.5, help="fraction of 0x92 I/O sample frames, the rest are 0x90")
+    parser.add_argument("--channels", type=int, default=1, choices=range(1, len(SAMPLE_CHANNELS) + 1), help="analog inputs per 0x92 frame")
+    parser.add_argument("--corrupt", type=float, default=0.0, help="fraction of frames with a bad checksum")
+    parser.add_argument("--noise", type=float, default=0.0, help="fraction of frames preceded by line noise")
+    parser.add_argument("--escaped", action="store_true", help="generate API mode 2 (AP=2) escaped frames")
+    parser.add_argument("--chunk-size", type=int, default=4096, help="most bytes returned per serial read")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--batch-wait", type=int, default=200)
+    parser.add_argument("--pool-size", type=int, default=4)
+    parser.add_argument("--engine", choices=("threads", "asyncio"), default="threads")
+    parser.add_argument("--drain-timeout", type=float, default=5, help="seconds to wait for stragglers once generation ends")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--log-level", default="ERROR")
+    parser.add_argument("--json", action="store_true", help="print the report as JSON")
+    args = parser.parse_args()
+
+    logging.basicConfig()
+    report = run_benchmark(args)
+    if args.json:
+        print(json.dumps(report))
+    else:
+        for name, value in report.items():
+            print("{:<20} {}".format(name, value))
+
+
+if __name__ == "__main__":
+    main()
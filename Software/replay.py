@@ -0,0 +1,112 @@
+"""Replay raw serial captures through the decoder and forwarder.
+
+Capture files are written by the hub when capture_path is set in
+configfile.ini. Payloads go to the destinations configured there unless
+--server-url is given.
+
+    python replay.py captures/                      # real time
+    python replay.py captures/ --speed 10           # ten times faster
+    python replay.py capture-20240101-120000-000000.xbcap.gz --speed 0 --server-url http://localhost:5000
+"""
+import argparse
+import threading
+import time
+from pathlib import Path
+
+
+def find_captures(paths):
+    captures = []
+    for path in map(Path, paths):
+        if path.is_dir():
+            captures.extend(sorted(path.glob("capture-*.xbcap.gz")))
+        else:
+            captures.append(path)
+    return captures
+
+# Wait until no new readings have come out of the decoder for settle_time seconds
+def wait_until_settled(app, deadline, settle_time=0.5):
+    def readings():
+        return app.payloads_queued.get() + app.payloads_filtered.get()
+
+    last_count = readings()
+    last_change = time.monotonic()
+    while time.monotonic() < deadline and time.monotonic() - last_change < settle_time:
+        time.sleep(0.05)
+        count = readings()
+        if count != last_count:
+            last_count = count
+            last_change = time.monotonic()
+
+# Whether every destination has accepted every queued payload
+def all_delivered(app):
+    queued = app.payloads_queued.get()
+    workers = list(app.destination_workers)
+    return all(app.payloads_delivered.get((worker.server_url,)) >= queued for worker in workers)
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay raw serial captures through the decoder and forwarder")
+    parser.add_argument("captures", nargs="+", help="capture files, or directories of them, replayed in order")
+    parser.add_argument("--speed", type=float, default=1.0, help="playback speed, 1 for real time, 0 for as fast as possible")
+    parser.add_argument("--server-url", help="post here instead of the configured server_url")
+    parser.add_argument("--api-key", help="API key to use with --server-url")
+    parser.add_argument("--api-mode", choices=("1", "2"), help="API mode the capture was recorded in, if not the configured one")
+    parser.add_argument("--engine", choices=("threads", "asyncio"), help="forwarding engine, if not the configured one")
+    parser.add_argument("--drain-timeout", type=float, default=30, help="seconds to wait for queued payloads to be sent at the end")
+    args = parser.parse_args()
+
+    captures = find_captures(args.captures)
+    if not captures:
+        raise SystemExit("No capture files found")
+
+    import app
+
+    settings = app.config["ServerConf"]
+    if args.server_url:
+        settings["server_url"] = args.server_url
+        settings["api_key"] = args.api_key or settings.get("api_key", "")
+    if args.api_mode:
+        settings["api_mode"] = args.api_mode
+    if args.engine:
+        settings["engine"] = args.engine
+    app.reload_parsed_config()
+
+    transport = app.ReplayTransport(captures, args.speed)
+    sources = [app.SerialSource(None, transport, None)]
+    start_time = time.monotonic()
+    if settings.get("engine", "threads") == "asyncio":
+        if app.aiohttp is None:
+            raise SystemExit("The asyncio engine needs aiohttp, install it with: pip install aiohttp")
+        engine = threading.Thread(target=app.asyncio.run, args=(app.run_async_engine(None, sources),), daemon=True)
+    else:
+        engine = threading.Thread(target=app.run_threaded_engine, args=(None, sources), daemon=True)
+    engine.start()
+
+    transport.finished.wait()
+    replay_time = time.monotonic() - start_time
+    deadline = time.monotonic() + args.drain_timeout
+
+    # Let the decoder finish the last reads, then close any edge filter windows
+    # still open, since no more readings are coming to close them
+    wait_until_settled(app, deadline)
+    app.queue_filtered_payloads(app.edge_filter.flush(close_all=True))
+
+    # Give the forwarder time to send whatever is still queued, collected into
+    # a batch or waiting to be posted again
+    while time.monotonic() < deadline:
+        if all_delivered(app):
+            break
+        time.sleep(0.1)
+
+    print("Replayed {} capture file(s) in {:.2f} seconds".format(len(captures), replay_time))
+    print("Bytes read:       {}".format(app.serial_bytes_read.get()))
+    print("Frames decoded:   {}".format(sum(app.frames_decoded.collect().values())))
+    print("Checksum errors:  {}".format(app.checksum_failures.get()))
+    print("Payloads queued:  {}".format(app.payloads_queued.get()))
+    for labels, count in sorted(app.payloads_delivered.collect().items()):
+        print("Delivered to {}: {}".format(labels[0], count))
+    for labels, count in sorted(app.posts_sent.collect().items()):
+        print("POSTs to {} ({}): {}".format(labels[0], labels[1], count))
+
+
+if __name__ == "__main__":
+    main()
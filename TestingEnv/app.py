@@ -5,15 +5,33 @@ import configparser
 from datetime import datetime
 from pathlib import Path
 import uuid
+import threading
+import collections
+import atexit
+import time
+import math
+import re
 import json
+import gzip
 import numpy
 
-from influxdb_client import InfluxDBClient, Point, WritePrecision, Task, TaskCreateRequest
+from influxdb_client import InfluxDBClient, Point, WritePrecision, Task, TaskCreateRequest, Dialect
 from influxdb_client.client.write_api import SYNCHRONOUS
 from influxdb_client.client.flux_table import FluxStructureEncoder
 from influxdb_client.client.exceptions import InfluxDBError
 from influxdb_client.rest import ApiException
 
+# Only needed to accept zstd compressed and MessagePack uploads
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
 # Paths and configuration
 source_path = Path(__file__).resolve()
 source_dir = source_path.parent
@@ -32,7 +50,13 @@ if not os.path.exists(configLocation):
         "influx_token": "your_influx_token_here",
         "influx_org": "your_influx_org_here",
         "influx_bucket": "your_influx_bucket_here",
-        "influx_url": "your_influx_url_here"
+        "influx_url": "your_influx_url_here",
+        "write_mode": "batching",
+        "write_batch_size": "5000",
+        "write_flush_interval": "1",
+        "write_buffer_size": "100000",
+        "write_max_retries": "5",
+        "query_cache_size": "1000"
     }
     write_file()
 else:
@@ -45,6 +69,15 @@ INFLUX_ORG = config["ServerConf"]["influx_org"]
 INFLUX_BUCKET = config["ServerConf"]["influx_bucket"]
 INFLUX_URL = config["ServerConf"]["influx_url"]
 
+# "batching" buffers points and writes them from a background thread, so
+# requests return as soon as their points are buffered. "synchronous" writes
+# them to InfluxDB before responding.
+WRITE_MODE = config["ServerConf"].get("write_mode", "batching")
+WRITE_BATCH_SIZE = config["ServerConf"].getint("write_batch_size", 5000)
+WRITE_FLUSH_INTERVAL = config["ServerConf"].getfloat("write_flush_interval", 1)
+WRITE_BUFFER_SIZE = config["ServerConf"].getint("write_buffer_size", 100000)
+WRITE_MAX_RETRIES = config["ServerConf"].getint("write_max_retries", 5)
+
 INFLUX_BUCKET_1H = INFLUX_BUCKET + "_1h"
 INFLUX_BUCKET_24H = INFLUX_BUCKET + "_24h"
 INFLUX_BUCKET_1W = INFLUX_BUCKET + "_1w"
@@ -68,6 +101,112 @@ query_api = client.query_api()
 def validate_token(token):
     return token == API_KEY
 
+class WriteBufferFull(Exception):
+    pass
+
+# Buffers points and writes them to InfluxDB in batches of up to batch_size
+# points, at least every flush_interval seconds. Failed writes are retried with
+# exponential backoff. While InfluxDB is slow or down the buffer fills up, and
+# once buffer_size points are waiting new points are refused with
+# WriteBufferFull, which is answered with a 503 so hubs hold on to the data
+# and retry.
+class InfluxBatchWriter(threading.Thread):
+    def __init__(self, batch_size, flush_interval, buffer_size, max_retries):
+        super().__init__(daemon=True)
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.buffer_size = buffer_size
+        self.max_retries = max_retries
+        self.pending = collections.deque()
+        self.buffered = 0
+        self.lock = threading.Lock()
+        self.ready = threading.Condition(self.lock)
+
+    # Buffer the points for each bucket in a {bucket: [points]} dict, all or
+    # nothing. nodes are the nodes the points are for.
+    def submit(self, points_by_bucket, nodes):
+        count = sum(len(points) for points in points_by_bucket.values())
+        with self.lock:
+            if self.buffered + count > self.buffer_size:
+                raise WriteBufferFull()
+            self.pending.append((points_by_bucket, nodes, count))
+            self.buffered += count
+            if self.buffered >= self.batch_size:
+                self.ready.notify()
+
+    # Take up to batch_size buffered points, grouped by bucket, and the nodes
+    # they are for
+    def take_batch(self):
+        batch = {}
+        nodes = set()
+        count = 0
+        while self.pending and count < self.batch_size:
+            points_by_bucket, entry_nodes, entry_count = self.pending.popleft()
+            for bucket, points in points_by_bucket.items():
+                batch.setdefault(bucket, []).extend(points)
+            nodes.update(entry_nodes)
+            count += entry_count
+        self.buffered -= count
+        return batch, nodes
+
+    def write_batch(self, batch, nodes):
+        for bucket, points in batch.items():
+            self.write(bucket, points)
+        query_cache.invalidate(nodes)
+
+    def run(self):
+        while True:
+            with self.lock:
+                self.ready.wait_for(lambda: self.buffered >= self.batch_size, timeout=self.flush_interval)
+                batch, nodes = self.take_batch()
+            if batch:
+                self.write_batch(batch, nodes)
+
+    # Write everything still buffered, used at exit
+    def flush(self):
+        while True:
+            with self.lock:
+                batch, nodes = self.take_batch()
+            if not batch:
+                return
+            self.write_batch(batch, nodes)
+
+    def write(self, bucket, points):
+        attempt = 0
+        while True:
+            try:
+                write_api.write(bucket, INFLUX_ORG, points)
+                return
+            except Exception as e:
+                # Client errors other than rate limiting won't go away on a retry
+                status = getattr(getattr(e, "response", None), "status", None)
+                retryable = status is None or status == 429 or status >= 500
+                if not retryable or attempt >= self.max_retries:
+                    print(f"Dropping {len(points)} points for {bucket}:", e)
+                    return
+                delay = min(0.5 * 2 ** attempt, 30)
+                attempt += 1
+                print(f"Write to {bucket} failed, retry {attempt} in {delay} seconds:", e)
+                time.sleep(delay)
+
+if WRITE_MODE == "batching":
+    influx_writer = InfluxBatchWriter(WRITE_BATCH_SIZE, WRITE_FLUSH_INTERVAL, WRITE_BUFFER_SIZE, WRITE_MAX_RETRIES)
+    influx_writer.start()
+    atexit.register(influx_writer.flush)
+else:
+    influx_writer = None
+
+# Write the points for each bucket in a {bucket: [points]} dict, or buffer them
+# for the batch writer. Cached queries for the nodes are dropped once the points
+# are written.
+def write_points(points_by_bucket, nodes):
+    if influx_writer is not None:
+        influx_writer.submit(points_by_bucket, nodes)
+        return
+    for bucket, points in points_by_bucket.items():
+        write_api.write(bucket, INFLUX_ORG, points)
+    query_cache.invalidate(nodes)
+
 if buckets_api.find_bucket_by_name(INFLUX_BUCKET_1H) is None:
     print(INFLUX_BUCKET_1H + " does not exist, creating...")
     buckets_api.create_bucket(bucket_name=INFLUX_BUCKET_1H, org=INFLUX_ORG, retention_rules=[{"type": "expire", "everySeconds": 3600}])
@@ -140,67 +279,232 @@ if not tasks_api.find_tasks(name=INFLUX_TASK_1M):
 def index():
     return render_template("index.html")
 
+# Check the Bearer token from the Authorization header, returning the error
+# response to send back if it is missing or invalid
+def authorization_error():
+    bearer_token = request.headers.get('Authorization')
+    if not bearer_token:
+        return "Unauthorized", 401
+
+    # Extract the token value from the Bearer token
+    token = bearer_token.split(' ')[1]
+
+    if not validate_token(token):
+        return "Unauthorized", 401
+
+    return None
+
+# Build the sensor data point for one reading
+def build_point(reading):
+    node = reading["source_address_64"]
+    value = float(reading["data"])
+    # Hubs send integer epoch milliseconds; older ones sent floats
+    time = reading_time(reading)
+    channel = reading.get("channel")
+
+    tags = {"node": node}
+    if channel:
+        tags["channel"] = channel
+
+    data_dict_structure = {
+        "measurement": "sensor_data",
+        "tags": tags,
+        "fields": {
+            "value": value,
+        },
+        "time": time
+    }
+
+    return Point.from_dict(data_dict_structure, WritePrecision.MS)
+
+def reading_time(reading):
+    return int(float(reading["date_time"]))
+
+# Build the device list point for a node seen for the first time. Every device
+# point has the same timestamp, so writing one again just overwrites it.
+def build_device_point(node, first_seen):
+    devices_dict_structure = {
+        "measurement": "devices_list",
+        "tags": {"node": node},
+        "fields": {
+            "node": node,
+            "first_seen": first_seen,
+        },
+        "time": "2023-01-01T00:00:00Z"
+    }
+    return Point.from_dict(devices_dict_structure)
+
+# Every node that has sent data, kept in memory so the devices bucket is only
+# written when a new node shows up and /devices doesn't need a query. Seeded
+# from the devices bucket at startup; last_seen and count cover readings since then.
+class DeviceRegistry:
+    def __init__(self):
+        self.devices = {}
+        self.lock = threading.Lock()
+
+    def seed(self):
+        query = f'''
+        from(bucket: "{INFLUX_BUCKET_DEVICES}")
+            |> range(start: 2023-01-01T00:00:00Z, stop: 2023-01-01T00:00:01Z)
+        '''
+        for record in query_api.query_stream(org=INFLUX_ORG, query=query):
+            device = self.devices.setdefault(record["node"], {"first_seen": None, "last_seen": None, "count": 0})
+            if record.get_field() == "first_seen":
+                device["first_seen"] = record.get_value()
+
+    # Nodes in the list that haven't been seen before
+    def unseen(self, nodes):
+        with self.lock:
+            return {node for node in nodes if node not in self.devices}
+
+    def record(self, readings):
+        with self.lock:
+            for reading in readings:
+                time = reading_time(reading)
+                device = self.devices.get(reading["source_address_64"])
+                if device is None:
+                    device = self.devices[reading["source_address_64"]] = {"first_seen": time, "last_seen": None, "count": 0}
+                if device["first_seen"] is None or time < device["first_seen"]:
+                    device["first_seen"] = time
+                if device["last_seen"] is None or time > device["last_seen"]:
+                    device["last_seen"] = time
+                device["count"] += 1
+
+    def list(self):
+        with self.lock:
+            return [
+                dict(device, id=index, node=node)
+                for index, (node, device) in enumerate(sorted(self.devices.items()))
+            ]
+
+device_registry = DeviceRegistry()
+device_registry.seed()
+
+# Build the points to write for a list of readings: one per reading, plus a
+# device point for every node not seen before
+def build_points(readings):
+    points = {INFLUX_BUCKET_1H: [build_point(reading) for reading in readings]}
+    new_nodes = device_registry.unseen({reading["source_address_64"] for reading in readings})
+    if new_nodes:
+        first_seen = {}
+        for reading in readings:
+            node = reading["source_address_64"]
+            if node in new_nodes:
+                first_seen[node] = min(first_seen.get(node, reading_time(reading)), reading_time(reading))
+        points[INFLUX_BUCKET_DEVICES] = [build_device_point(node, time) for node, time in first_seen.items()]
+    return points
+
+# Content types of the hub's columnar upload format, see encode_columnar() in Software/app.py
+COLUMNAR_JSON = "application/vnd.xbee-columnar+json"
+COLUMNAR_MSGPACK = "application/vnd.xbee-columnar+msgpack"
+
+class UnsupportedEncoding(Exception):
+    pass
+
+# Expand a columnar upload back into readings
+def decode_columnar(body):
+    nodes = body["nodes"]
+    channels = body.get("channel")
+    radios = body.get("radio")
+
+    readings = []
+    timestamp = body["base_time"]
+    for i, (node, time_delta, value) in enumerate(zip(body["node"], body["time"], body["data"])):
+        timestamp += time_delta
+        reading = {"source_address_64": nodes[node], "date_time": timestamp, "data": value}
+        if channels and channels[i] is not None:
+            reading["channel"] = channels[i]
+        if radios and radios[i] is not None:
+            reading["radio"] = radios[i]
+        readings.append(reading)
+    return readings
+
+# Read the request body, undoing any compression and columnar encoding.
+# Raises UnsupportedEncoding for anything this server can't read, which is
+# answered with a 415 so the hub falls back to plain JSON.
+def read_upload():
+    data = request.get_data()
+
+    # Older hubs send "Content-Encoding: utf-8" with plain JSON
+    encoding = request.headers.get("Content-Encoding", "identity").lower()
+    if encoding == "gzip":
+        data = gzip.decompress(data)
+    elif encoding == "zstd" and zstandard is not None:
+        data = zstandard.ZstdDecompressor().decompress(data)
+    elif encoding not in ("identity", "utf-8"):
+        raise UnsupportedEncoding(f"Unsupported Content-Encoding: {encoding}")
+
+    if request.mimetype == COLUMNAR_MSGPACK:
+        if msgpack is None:
+            raise UnsupportedEncoding("MessagePack uploads are not supported")
+        return decode_columnar(msgpack.unpackb(data))
+    if request.mimetype == COLUMNAR_JSON:
+        return decode_columnar(json.loads(data))
+    return json.loads(data)
+
+# The write buffer is full because InfluxDB is falling behind. Hubs retry 5xx
+# responses with backoff, so the readings aren't lost.
+def write_buffer_full_response():
+    return {"error": "Write buffer full, retry later"}, 503, {"Retry-After": str(max(1, round(WRITE_FLUSH_INTERVAL)))}
+
+# Turn an InfluxDB write failure into an error response
+def influx_error_response(e):
+    status = e.response.status if e.response is not None else 500
+    if status == 401:
+        return {"error": "Insufficent permissions"}, status
+    if status == 404:
+        return {"error": f"Bucket {INFLUX_BUCKET} does not exist"}, status
+    return {"error": str(e)}, 500
+
 @app.route('/api/v1/sensors', methods=['POST'])
 def receive_data():
     try:
-        # Get the Bearer token from the Authorization header
-        bearer_token = request.headers.get('Authorization')
-        if not bearer_token:
-            return "Unauthorized", 401
-
-        # Extract the token value from the Bearer token
-        token = bearer_token.split(' ')[1]
+        error = authorization_error()
+        if error:
+            return error
 
-        if not validate_token(token):
-            return "Unauthorized", 401
-
-        data = request.get_json()
+        data = read_upload()
         print("Received POST request data:")
         print(data)
 
-
-        node = request.json["source_address_64"]
-        value = request.json["data"]
-        time = request.json["date_time"]
-
-        # point = (
-        #     Point("sensor_data")
-        #     .tag("node", node)
-        #     .field("value", value)
-        #     .time(time, WritePrecision.NS)
-        # )
-
-        value = float(value)
-
-        data_dict_structure = {
-            "measurement": "sensor_data",
-            "tags": {"node": node},
-            "fields": {
-                "value": value,
-            },
-            "time": time
-        }
-        
-        devices_dict_structure = {
-            "measurement": "devices_list",
-            "tags": {"node": node},
-            "fields": {
-                "node": node,
-            },
-            "time": "2023-01-01T00:00:00Z"
-        }
-
-        data_point = Point.from_dict(data_dict_structure)
-        devices_point = Point.from_dict(devices_dict_structure)
-        write_api.write(INFLUX_BUCKET_1H, INFLUX_ORG, data_point)
-        write_api.write(INFLUX_BUCKET_DEVICES, INFLUX_ORG, devices_point)
+        write_points(build_points([data]), {data["source_address_64"]})
+        device_registry.record([data])
         return {"result": "data accepted for processing"}, 200
     
+    except WriteBufferFull:
+        return write_buffer_full_response()
+    except UnsupportedEncoding as e:
+        return {"error": str(e)}, 415
+    except InfluxDBError as e:
+        return influx_error_response(e)
+    except Exception as e:
+        print("Error:", e)
+        return "Error processing data", 500
+
+# Accepts a JSON array of readings in the same format as /api/v1/sensors and
+# writes them together
+@app.route('/api/v1/sensors/batch', methods=['POST'])
+def receive_batch():
+    try:
+        error = authorization_error()
+        if error:
+            return error
+
+        readings = read_upload()
+        if not isinstance(readings, list):
+            return {"error": "Expected a list of readings"}, 400
+        print("Received POST batch of", len(readings), "readings")
+
+        write_points(build_points(readings), {reading["source_address_64"] for reading in readings})
+        device_registry.record(readings)
+        return {"result": f"{len(readings)} readings accepted for processing"}, 200
+
+    except WriteBufferFull:
+        return write_buffer_full_response()
+    except UnsupportedEncoding as e:
+        return {"error": str(e)}, 415
     except InfluxDBError as e:
-        if e.response.status == "401":
-            return {"error": "Insufficent permissions"}, e.response.status
-        if e.response.status == "404":
-            return {"error": f"Bucket {INFLUX_BUCKET} does not exist"}, e.response.status
+        return influx_error_response(e)
     except Exception as e:
         print("Error:", e)
         return "Error processing data", 500
@@ -226,10 +530,176 @@ def auth_check():
     except Exception as e:
         return jsonify({"error": str(e)})
 
+# Caches /data results for up to ttl seconds, keeping at most max_entries of them
+# and dropping the least recently used first. Keys start with (device, range).
+# Ranges other than 1h are served from buckets that are only filled by the
+# aggregation tasks, so their results can be kept much longer.
+QUERY_CACHE_TTL = {"1h": 5, "24h": 300, "1w": 3600, "1m": 3600}
+
+class QueryCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if time.monotonic() >= expires:
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (time.monotonic() + ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    # Drop the cached 1h results for nodes that have just had data written
+    def invalidate(self, nodes):
+        if not nodes:
+            return
+        with self.lock:
+            for key in [key for key in self.entries if key[0] in nodes and key[1] == "1h"]:
+                del self.entries[key]
+
+query_cache = QueryCache(config["ServerConf"].getint("query_cache_size", 1000))
+
+# Length of each /data range in seconds, used to size the windows for max_points
+RANGE_SECONDS = {"1h": 3600, "24h": 86400, "1w": 604800, "4w": 2419200}
+AGGREGATE_FUNCTIONS = ("mean", "min", "max")
+FLUX_DURATION = re.compile(r"[1-9][0-9]*(ms|s|m|h|d|w)")
+CHANNEL_NAME = re.compile(r"[A-Z]+[0-9]*")
+DATA_FORMATS = ("rows", "columnar")
+
+# Responses smaller than this are sent uncompressed
+GZIP_MIN_BYTES = 1024
+
+# gzip the response body if the client accepts it
+def negotiate_encoding(response):
+    response.vary.add("Accept-Encoding")
+    if request.accept_encodings["gzip"] <= 0 or "Content-Encoding" in response.headers:
+        return response
+    body = response.get_data()
+    if len(body) < GZIP_MIN_BYTES:
+        return response
+    response.set_data(gzip.compress(body, compresslevel=5))
+    response.headers["Content-Encoding"] = "gzip"
+    return response
+
+# Build the /data response. Columnar results are cached already serialized.
+def data_response(data, response_format):
+    if response_format == "columnar":
+        response = app.response_class(data, mimetype="application/json")
+    else:
+        response = jsonify(data)
+    return negotiate_encoding(response)
+
+# {"t": [epoch milliseconds...], "v": [values...]} as compact JSON
+def encode_columnar_data(t, v):
+    return json.dumps({"t": t.tolist(), "v": v.tolist()}, separators=(",", ":")).encode()
+
+# Appended to a /data query for the columnar format. InfluxDB merges the
+# series into one table in time order and works out the epoch milliseconds, so
+# only two plain columns come back.
+COLUMNAR_QUERY_SUFFIX = '''
+        |> group()
+        |> sort(columns: ["_time"])
+        |> map(fn: (r) => ({r with t: int(v: r._time) / 1000000}))
+        |> keep(columns: ["t", "_value"])
+'''
+CSV_DIALECT = Dialect(header=True, annotations=[])
+
+# Run a query ending in COLUMNAR_QUERY_SUFFIX and return its t and _value columns
+# as arrays, straight from the CSV response without building a record per row
+def query_columns(query):
+    rows = iter(query_api.query_csv(query + COLUMNAR_QUERY_SUFFIX, org=INFLUX_ORG, dialect=CSV_DIALECT))
+    header = next((row for row in rows if row), None)
+    if header is None:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=float)
+    t_index = header.index("t")
+    v_index = header.index("_value")
+    # Tables are separated by a blank line and repeat the header
+    data = [row for row in rows if len(row) == len(header) and row != header]
+    if not data:
+        return numpy.empty(0, dtype=numpy.int64), numpy.empty(0, dtype=float)
+    columns = list(zip(*data))
+    return numpy.array(columns[t_index], dtype=numpy.int64), numpy.array(columns[v_index], dtype=float)
+
+# Largest-Triangle-Three-Buckets: pick threshold points that keep the visual
+# shape of the series, always keeping the first and last. Returns their indices.
+def lttb_indices(x, y, threshold):
+    n = len(x)
+    if threshold >= n:
+        return numpy.arange(n)
+    if threshold < 3:
+        return numpy.array([0, n - 1][:threshold])
+
+    bucket_size = (n - 2) / (threshold - 2)
+    indices = numpy.empty(threshold, dtype=int)
+    indices[0] = 0
+    indices[-1] = n - 1
+
+    selected = 0
+    for i in range(threshold - 2):
+        start = int(i * bucket_size) + 1
+        end = int((i + 1) * bucket_size) + 1
+        # The point picked from this bucket forms the largest triangle with the
+        # last selected point and the average of the next bucket
+        next_end = min(int((i + 2) * bucket_size) + 1, n)
+        average_x = x[end:next_end].mean()
+        average_y = y[end:next_end].mean()
+        areas = numpy.abs(
+            (x[selected] - average_x) * (y[start:end] - y[selected])
+            - (x[selected] - x[start:end]) * (average_y - y[selected])
+        )
+        selected = start + int(areas.argmax())
+        indices[i + 1] = selected
+    return indices
+
+# Optional parameters:
+#   every       aggregate into windows of this Flux duration, e.g. 30s or 5m
+#   max_points  aggregate into windows sized to return at most this many points
+#               per series, or with decimate=lttb the most points LTTB keeps
+#   fn          mean (default), min or max for the windows
+#   decimate    lttb to thin out the points with Largest-Triangle-Three-Buckets
+#               instead of aggregating
 @app.route('/data')
 def get_data():
     device = request.args.get('device')
     time_range = request.args.get('range')
+    every = request.args.get('every')
+    max_points = request.args.get('max_points')
+    fn = request.args.get('fn', 'mean')
+    decimate = request.args.get('decimate')
+    response_format = request.args.get('format', 'rows')
+    channel = request.args.get('channel')
+
+    if every is not None and not FLUX_DURATION.fullmatch(every):
+        return {"error": "every must be a duration such as 30s or 5m"}, 400
+    if max_points is not None:
+        try:
+            max_points = int(max_points)
+        except ValueError:
+            return {"error": "max_points must be an integer"}, 400
+        if max_points < 1:
+            return {"error": "max_points must be at least 1"}, 400
+    if fn not in AGGREGATE_FUNCTIONS:
+        return {"error": f"fn must be one of {', '.join(AGGREGATE_FUNCTIONS)}"}, 400
+    if decimate not in (None, "lttb"):
+        return {"error": "decimate must be lttb"}, 400
+    if decimate is not None and max_points is None:
+        return {"error": "decimate needs max_points"}, 400
+    if response_format not in DATA_FORMATS:
+        return {"error": f"format must be one of {', '.join(DATA_FORMATS)}"}, 400
+    if channel is not None and not CHANNEL_NAME.fullmatch(channel):
+        return {"error": "channel must be a channel name such as AD1 or DIO0"}, 400
 
     if time_range == '1h':
         bucket = INFLUX_BUCKET_1H
@@ -244,41 +714,65 @@ def get_data():
         bucket = INFLUX_BUCKET_1M  # Use the 1w bucket for 1 Month
         duration = '4w'  # Adjust the duration as needed
     else:
-        return jsonify([])  # Invalid time range, return empty data
+        # Invalid time range, return empty data
+        if response_format == "columnar":
+            return data_response(encode_columnar_data(numpy.empty(0, dtype=numpy.int64), numpy.empty(0)), response_format)
+        return jsonify([])
+
+    cache_key = (device, time_range, channel, every, max_points, fn, decimate, response_format)
+    data = query_cache.get(cache_key)
+    if data is not None:
+        return data_response(data, response_format)
+
+    # Let InfluxDB do the aggregation so only the windows come back. Windows
+    # are aligned to the epoch rather than to the start of the range, so the
+    # range can be cut into one more window than it holds: size them for
+    # max_points - 1 and keep only the last max_points in case that's still over.
+    limit = ""
+    if every is None and max_points is not None and decimate is None:
+        every = f"{math.ceil(RANGE_SECONDS[duration] / max(max_points - 1, 1))}s"
+        limit = f"|> tail(n: {max_points})"
+    # Readings without a channel tag are the node's main value (0x90 packets and AD0)
+    if channel is None:
+        channel_filter = '|> filter(fn: (r) => not exists r.channel)'
+    else:
+        channel_filter = f'|> filter(fn: (r) => r.channel == "{channel}")'
+    aggregate = f"|> aggregateWindow(every: {every}, fn: {fn}, createEmpty: false)" if every else ""
 
     query = f'''
     from(bucket: "{bucket}")
         |> range(start: -{duration})
         |> filter(fn: (r) => r._measurement == "sensor_data" and r.node == "{device}")
+        {channel_filter}
+        {aggregate}
+        {limit}
     '''
     
-    result = query_api.query(org=INFLUX_ORG, query=query)
-    data = []
-
-    for table in result:
-        for record in table.records:
-            data.append({
-                "time": record.get_time(),
-                "value": record.get_value()
-            })
-    
-    return jsonify(data)
+    if response_format == "columnar":
+        t, v = query_columns(query)
+        if decimate == "lttb" and len(t) > max_points:
+            indices = lttb_indices(t.astype(float), v, max_points)
+            t, v = t[indices], v[indices]
+        data = encode_columnar_data(t, v)
+    else:
+        data = []
+        for table in query_api.query(org=INFLUX_ORG, query=query):
+            records = table.records
+            if decimate == "lttb" and len(records) > max_points:
+                x = numpy.array([record.get_time().timestamp() for record in records])
+                y = numpy.array([record.get_value() for record in records], dtype=float)
+                records = [records[i] for i in lttb_indices(x, y, max_points)]
+
+            for record in records:
+                data.append({"time": record.get_time(), "value": record.get_value()})
+
+    query_cache.put(cache_key, data, QUERY_CACHE_TTL[time_range])
+    return data_response(data, response_format)
     
+# Served from the device registry. first_seen and last_seen are epoch milliseconds.
 @app.route("/devices", methods=["GET"])
 def get_devices():
-    query = f'''
-    from(bucket: "{INFLUX_BUCKET_DEVICES}")
-        |> range(start: 2023-01-01T00:00:00Z, stop: 2023-01-01T00:00:01Z)
-    '''
-    
-    records = query_api.query_stream(org=INFLUX_ORG, query=query)
-
-    devices = []  # Initialize the devices list outside the loop
-
-    for record in records:
-        devices.append({"id": record["table"], "node": record["node"]})  # Append each record to the devices list
-        
-    return jsonify(devices)
+    return jsonify(device_registry.list())
 
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=5000)
\ No newline at end of file